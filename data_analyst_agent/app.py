@@ -1,14 +1,24 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 import google.generativeai as genai
 import json
 import os
-import datetime
-import re
-import pandas as pd
 import base64
+import hashlib
 from prompts import PLANNER_PROMPT
 from logger_setup import log
-from tools import web_scraper, python_interpreter, build_docker_image
+from tools import build_docker_image
+from ingest import create_workspace, remove_workspace, spool_uploads, load_dataset, DATA_EXTENSIONS, IMAGE_EXTENSIONS
+from web_cache import get_web_cache
+from sandbox_pool import get_sandbox_pool, SANDBOX_EXEC_TIMEOUT
+from model_pool import GeminiModelPool
+from plan_cache import PlanCache, make_plan_cache_key, PLAN_CACHE_ENABLED, PLAN_CACHE_BYPASS_HEADER
+from step_cache import get_step_cache, STEP_CACHE_BYPASS_HEADER
+from jobs import JobManager, JobQueueFullError
+from plan_executor import run_plan, prefetch_step, PlanTimeoutError
+from plan_stream import stream_plan, parse_plan_text, PLAN_STREAMING_ENABLED
+from tracing import Trace, span, use_trace, metrics
+from diagnostics import get_diagnostics_store
+from images import prepare_input_image, optimize_answer_images
 
 app = Flask(__name__)
 
@@ -17,181 +27,279 @@ GEMINI_API_KEYS = [
     "GEMINI_API_KEY_2",
 ]
 
-DIAGNOSTICS_DIR = "diagnostics"
 MODEL_NAME = 'gemini-2.0-flash'
 
-if not os.path.exists(DIAGNOSTICS_DIR):
-    os.makedirs(DIAGNOSTICS_DIR)
+model_pool = GeminiModelPool(GEMINI_API_KEYS, MODEL_NAME)
+plan_cache = PlanCache() if PLAN_CACHE_ENABLED else None
+job_manager = JobManager()
 
 
-def get_gemini_model_with_retry():
-    if not GEMINI_API_KEYS or not any(key.strip() for key in GEMINI_API_KEYS):
-        raise ValueError("GEMINI_API_KEYS list is empty.")
+def parse_deadline(value):
+    # Absent means the default deadline; anything present must be a number, so a typo is not silently ignored.
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"deadline must be a positive number of seconds, got '{value}'.")
 
-    for i, key in enumerate(GEMINI_API_KEYS):
-        key = key.strip()
-        if not key:
-            continue
-        try:
-            log.info(f"Attempting to configure Gemini API with key #{i + 1}...")
-            genai.configure(api_key=key)
-            model = genai.GenerativeModel(MODEL_NAME)
-            model.generate_content("test", generation_config=genai.types.GenerationConfig(max_output_tokens=1))
-            log.info(f"Successfully configured Gemini with key #{i + 1} using {MODEL_NAME}.")
-            return model
-        except Exception as e:
-            log.warning(f"Failed to use Gemini API key #{i + 1}. Error: {e}")
 
-    raise ConnectionError("All provided Gemini API keys failed.")
+def submit_analysis_job():
+    # Uploads are spooled to disk here because the request streams are closed once the handler returns.
+    questions = request.files['questions.txt'].read().decode('utf-8')
+    workspace = create_workspace()
+    trace = Trace()
+    try:
+        with use_trace(trace), span("upload_spool") as spool_span:
+            uploads = spool_uploads([(field_name, file_storage) for field_name, file_storage in request.files.items()
+                                     if field_name != 'questions.txt'], workspace)
+            spool_span.add_bytes(sum(os.path.getsize(path) for _, path in uploads))
+        bypass_plan_cache = request.headers.get(PLAN_CACHE_BYPASS_HEADER, "").lower() == "bypass"
+        bypass_step_cache = request.headers.get(STEP_CACHE_BYPASS_HEADER, "").lower() == "bypass"
+        deadline = parse_deadline(request.values.get("deadline"))
+        return job_manager.submit(run_analysis, deadline, questions=questions, uploads=uploads,
+                                  workspace=workspace, trace=trace, remote_addr=request.remote_addr,
+                                  bypass_plan_cache=bypass_plan_cache, bypass_step_cache=bypass_step_cache)
+    except Exception:
+        remove_workspace(workspace)
+        raise
 
 
 @app.route('/api/', methods=['POST'])
 def analyze_data():
-    start_time = datetime.datetime.now()
+    if 'questions.txt' not in request.files:
+        return jsonify({"error": "questions.txt is a required file."}), 400
+    try:
+        job = submit_analysis_job()
+    except JobQueueFullError as e:
+        return jsonify({"error": str(e)}), 503
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not job.wait_for_deadline(SANDBOX_EXEC_TIMEOUT):
+        log.error(f"Job {job.id} did not finish within its deadline. Cancelling it.")
+        job.cancel()
+        return jsonify({"error": "Processing timed out."}), 500
+    return jsonify(job.result), job.http_status
+
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    if 'questions.txt' not in request.files:
+        return jsonify({"error": "questions.txt is a required file."}), 400
+    try:
+        job = submit_analysis_job()
+    except JobQueueFullError as e:
+        return jsonify({"error": str(e)}), 503
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"job_id": job.id, "status": job.status, "status_url": f"/api/jobs/{job.id}"}), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job id: {job_id}"}), 404
+    return jsonify(job.to_dict())
 
+
+def run_analysis(job, workspace: str, trace: Trace, remote_addr: str, **kwargs):
+    http_status = 500
+    diagnostics = get_diagnostics_store().start_request(remote_addr, trace.request_id)
+    try:
+        with use_trace(trace), span("request"):
+            result, http_status = analyze_request(job, diagnostics, **kwargs)
+        return result, http_status
+    finally:
+        remove_workspace(workspace)
+        metrics.record_request(http_status)
+        diagnostics.close(http_status, trace)
+
+
+def analyze_request(job, diagnostics, questions: str, uploads: list,
+                    bypass_plan_cache: bool = False, bypass_step_cache: bool = False):
     try:
-        ip_address = request.remote_addr.replace(":", "_")
-        timestamp = start_time.strftime("%Y-%m-%d_%H-%M-%S")
-        request_diag_folder = os.path.join(DIAGNOSTICS_DIR, f"{ip_address}_{timestamp}")
-        os.makedirs(request_diag_folder)
-        log.info(f"Created diagnostics folder: {request_diag_folder}")
-
-        if 'questions.txt' not in request.files:
-            return jsonify({"error": "questions.txt is a required file."}), 400
-        questions = request.files['questions.txt'].read().decode('utf-8')
-        with open(os.path.join(request_diag_folder, "01_request_questions.txt"), "w") as f:
-            f.write(questions)
-
-        context_data = None
-        context_filename = None
+        log.info(f"Collecting diagnostics for {diagnostics.folder}")
+        diagnostics.add("01_request_questions.txt", questions)
+
+        uploaded_files = {}
+        duckdb_tables = {}
         image_contexts = []
+        image_hashes = []
+        image_names = {}
+        column_dtypes = {}
         schema_info_parts = []
 
-        for field_name, file_storage in request.files.items():
-            if field_name == 'questions.txt':
-                continue
-
+        for field_name, path in uploads:
             file_name_lower = field_name.lower()
-            if file_name_lower.endswith('.csv'):
-                log.info(f"Found uploaded CSV file: {field_name}")
-                context_data = pd.read_csv(file_storage.stream)
-                context_filename = field_name
-                schema_info_parts.append(
-                    f"a data file named '{field_name}' with columns: {context_data.columns.tolist()}")
-
-            elif file_name_lower.endswith('.xlsx'):
-                log.info(f"Found uploaded Excel file: {field_name}")
-                context_data = pd.read_excel(file_storage.stream)
-                context_filename = field_name
-                schema_info_parts.append(
-                    f"a data file named '{field_name}' with columns: {context_data.columns.tolist()}")
-
-            elif file_name_lower.endswith(('.png', '.jpg', '.jpeg')):
+            if file_name_lower.endswith(DATA_EXTENSIONS):
+                log.info(f"Found uploaded data file: {field_name}")
+                with span("upload_parse", tool=file_name_lower.rsplit('.', 1)[-1]) as parse_span:
+                    dataset = load_dataset(field_name, path)
+                    parse_span.add_bytes(dataset.size_bytes)
+                    parse_span.set(large=bool(dataset.tables))
+                uploaded_files.update(dataset.sandbox_files)
+                duckdb_tables.update(dataset.tables)
+                column_dtypes[field_name] = dataset.dtypes
+                schema_info_parts.append(dataset.describe())
+
+            elif file_name_lower.endswith(IMAGE_EXTENSIONS):
                 log.info(f"Found uploaded image: {field_name}")
-                # Extract mime type and encode image for multimodal input
-                mime_type = f"image/{file_name_lower.split('.')[-1]}"
-                img_base64 = base64.b64encode(file_storage.read()).decode('utf-8')
-                image_contexts.append({"mime_type": mime_type, "data": img_base64})
-                schema_info_parts.append(f"an image file named '{field_name}'")
+                with span("upload_parse", tool="image") as parse_span, open(path, "rb") as f:
+                    file_bytes = f.read()
+                    parse_span.add_bytes(len(file_bytes))
+                image_hash = hashlib.sha256(file_bytes).hexdigest()
+                image_hashes.append(image_hash)
+                if image_hash in image_names:
+                    log.info(f"Image '{field_name}' is identical to '{image_names[image_hash]}'. Sending it once.")
+                    schema_info_parts.append(f"an image file named '{field_name}' "
+                                             f"(identical to '{image_names[image_hash]}')")
+                else:
+                    image_names[image_hash] = field_name
+                    # Downscale and re-encode the image before encoding it for multimodal input
+                    with span("image_encode", tool="image") as encode_span:
+                        image_bytes, mime_type = prepare_input_image(file_bytes, field_name)
+                        encode_span.add_bytes(len(image_bytes))
+                        encode_span.set(original_bytes=len(file_bytes), encoded_bytes=len(image_bytes))
+                    log.info(f"Prepared image '{field_name}' ({mime_type}): {len(file_bytes)} -> "
+                             f"{len(image_bytes)} bytes.")
+                    img_base64 = base64.b64encode(image_bytes).decode('utf-8')
+                    image_contexts.append({"mime_type": mime_type, "data": img_base64})
+                    schema_info_parts.append(f"an image file named '{field_name}'")
 
         if not schema_info_parts:
             schema_info = "No data or image files were uploaded."
         else:
             schema_info = "The user uploaded " + " and ".join(schema_info_parts) + "."
 
+        plan_cache_key = make_plan_cache_key(questions, schema_info, column_dtypes, image_hashes,
+                                             MODEL_NAME, PLANNER_PROMPT)
+
     except Exception as e:
         log.error("FATAL: Error during setup or request parsing.", exc_info=True)
-        return jsonify({"error": f"Internal server error: {e}"}), 500
+        return {"error": f"Internal server error: {e}"}, 500
+
+    plan = None
+    plan_from_cache = False
+    prefetched = {}
+    if plan_cache is not None and not bypass_plan_cache:
+        with span("plan_cache_lookup") as lookup_span:
+            plan = plan_cache.get(plan_cache_key)
+            lookup_span.set(hit=plan is not None)
+        plan_from_cache = plan is not None
+        if plan_from_cache:
+            log.info(f"Plan cache hit ({plan_cache_key[:12]}). Skipping the planning call.")
+            diagnostics.add("03_gemini_parsed_plan.json", json.dumps(plan, indent=4))
+
+    if plan is None:
+        try:
+            text_prompt = PLANNER_PROMPT.format(
+                user_questions=questions,
+                uploaded_file_schema=schema_info
+            )
+
+            # Prepare content for multimodal generation
+            content_parts = [text_prompt]
+            content_parts.extend(image_contexts)
+
+            generation_config = genai.types.GenerationConfig(
+                max_output_tokens=8192,
+                temperature=0.1
+            )
+            with span("planning", streamed=PLAN_STREAMING_ENABLED) as planning_span:
+                if PLAN_STREAMING_ENABLED:
+                    raw_response, plan = stream_plan(model_pool, content_parts, generation_config,
+                                                     on_step=lambda step: prefetch_step(step, prefetched))
+                else:
+                    response = model_pool.generate_content(content_parts, generation_config=generation_config)
+                    raw_response = response.text
+                    plan = parse_plan_text(raw_response)
+                planning_span.add_bytes(len(raw_response))
+                planning_span.set(steps=len(plan))
+
+            diagnostics.add("02_gemini_raw_response.txt", raw_response)
+            diagnostics.add("03_gemini_parsed_plan.json", json.dumps(plan, indent=4))
+            log.info(f"Received and parsed a plan with {len(plan)} steps.")
+        except Exception as e:
+            log.error(f"Failed to get or parse plan from Gemini.", exc_info=True)
+            return {"error": f"Failed to get or parse plan from LLM: {e}"}, 500
+
+    if not plan:
+        return {"error": "LLM generated an empty plan."}, 500
 
     try:
-        model = get_gemini_model_with_retry()
-        text_prompt = PLANNER_PROMPT.format(
-            user_questions=questions,
-            uploaded_file_schema=schema_info
-        )
-
-        # Prepare content for multimodal generation
-        content_parts = [text_prompt]
-        content_parts.extend(image_contexts)
-
-        generation_config = genai.types.GenerationConfig(
-            max_output_tokens=8192,
-            temperature=0.1
-        )
-        response = model.generate_content(content_parts, generation_config=generation_config)
-
-        with open(os.path.join(request_diag_folder, "02_gemini_raw_response.txt"), "w") as f:
-            f.write(response.text)
-
-        json_match = re.search(r'\[.*\]', response.text, re.DOTALL)
-        if not json_match:
-            raise json.JSONDecodeError("No JSON array found in LLM response.", response.text, 0)
-
-        plan_str = json_match.group(0)
-        plan = json.loads(plan_str)
-
-        with open(os.path.join(request_diag_folder, "03_gemini_parsed_plan.json"), "w") as f:
-            json.dump(plan, f, indent=4)
-        log.info(f"Received and parsed a plan with {len(plan)} steps.")
+        stdout = run_plan(plan, job, files=uploaded_files, prefetched=prefetched, tables=duckdb_tables,
+                          cache_steps=not bypass_step_cache)
+    except PlanTimeoutError:
+        return {"error": "Processing timed out."}, 500
     except Exception as e:
-        log.error(f"Failed to get or parse plan from Gemini.", exc_info=True)
-        return jsonify({"error": f"Failed to get or parse plan from LLM: {e}"}), 500
+        return {"error": f"Execution failed: {e}"}, 500
 
-    if not plan:
-        return jsonify({"error": "LLM generated an empty plan."}), 500
+    if stdout is None:
+        log.error("Execution loop completed without returning a response from a final step.")
+        return {"error": "Agent finished plan but did not produce a final answer."}, 500
 
+    log.info("Final step executed. Preparing response.")
+    diagnostics.add("04_final_step_stdout.txt", stdout)
     try:
-        final_step_index = len(plan) - 1
-        for i, step in enumerate(plan):
-            tool_name = step.get("tool")
-            args = step.get("args", {})
-            is_final_step = (i == final_step_index)
-            log.info(f"Executing {'FINAL' if is_final_step else 'INTERMEDIATE'} step {i + 1}: tool='{tool_name}'")
-
-            if (datetime.datetime.now() - start_time).total_seconds() > 280:
-                log.error("Execution timed out before completing all steps.")
-                return jsonify({"error": "Processing timed out."}), 500
-
-            if tool_name == "web_scraper":
-                context_data = web_scraper(url=args.get("url"))
-            elif tool_name == "python_interpreter":
-                stdout, modified_df = python_interpreter(
-                    code=args.get("code"),
-                    data=context_data,
-                    filename=context_filename
-                )
-                context_data = modified_df
-                context_filename = None
-
-                if is_final_step:
-                    log.info("Final step executed. Preparing response.")
-                    with open(os.path.join(request_diag_folder, "04_final_step_stdout.txt"), "w") as f:
-                        f.write(stdout)
-                    try:
-                        final_response_obj = json.loads(stdout)
-                        with open(os.path.join(request_diag_folder, "05_final_output.json"), "w") as f:
-                            json.dump(final_response_obj, f, indent=4)
-                        log.info("Request fully processed. Returning final JSON object.")
-                        return jsonify(final_response_obj)
-                    except json.JSONDecodeError:
-                        log.error(f"FATAL: The final step's output was not valid JSON. Output: {stdout}", exc_info=True)
-                        return jsonify(
-                            {"error": "The agent failed to produce a valid JSON response in the final step."}), 500
-            else:
-                log.warning(f"Unknown tool '{tool_name}' requested in plan.")
-                if is_final_step:
-                    return jsonify({"error": f"Final step requested an unknown tool: {tool_name}"}), 500
-    except Exception as e:
-        log.error(f"Error during plan execution at step {i + 1}.", exc_info=True)
-        return jsonify({"error": f"Execution failed: {e}"}), 500
+        final_response_obj = json.loads(stdout)
+        with span("image_output", tool="image") as image_span:
+            final_response_obj, image_sizes = optimize_answer_images(final_response_obj)
+            if image_sizes:
+                original_bytes = sum(before for before, _ in image_sizes)
+                optimized_bytes = sum(after for _, after in image_sizes)
+                image_span.add_bytes(optimized_bytes)
+                image_span.set(images=len(image_sizes), original_bytes=original_bytes,
+                               optimized_bytes=optimized_bytes)
+                log.info(f"Answer images: {len(image_sizes)} image(s), {original_bytes} -> {optimized_bytes} bytes.")
+        diagnostics.add("05_final_output.json", json.dumps(final_response_obj, indent=4))
+        # Only fresh plans are stored: re-storing a cached plan would reset its age and it would never expire.
+        if plan_cache is not None and not plan_from_cache:
+            plan_cache.put(plan_cache_key, plan)
+        log.info("Request fully processed. Returning final JSON object.")
+        return final_response_obj, 200
+    except json.JSONDecodeError:
+        log.error(f"FATAL: The final step's output was not valid JSON. Output: {stdout}", exc_info=True)
+        return {"error": "The agent failed to produce a valid JSON response in the final step."}, 500
+
+
+@app.route('/api/web-cache/stats', methods=['GET'])
+def web_cache_stats():
+    return jsonify(get_web_cache().stats())
+
+
+@app.route('/api/step-cache/stats', methods=['GET'])
+def step_cache_stats():
+    return jsonify(get_step_cache().stats())
+
+
+@app.route('/api/diagnostics/stats', methods=['GET'])
+def diagnostics_stats():
+    return jsonify(get_diagnostics_store().stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    gauges = {"agent_jobs_pending": job_manager.stats()["pending"],
+              "agent_diagnostics_queued": get_diagnostics_store().stats()["queued"]}
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
 
-    log.error("Execution loop completed without returning a response from a final step.")
-    return jsonify({"error": "Agent finished plan but did not produce a final answer."}), 500
+@app.route('/api/plan-cache/stats', methods=['GET'])
+def plan_cache_stats():
+    if plan_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(plan_cache.stats())
 
 
 if __name__ == '__main__':
     try:
-        build_docker_image()
+        sandbox_pool = get_sandbox_pool()
+        if sandbox_pool.backend == "docker":
+            build_docker_image()
+        sandbox_pool.start()
+        get_diagnostics_store()
         app.run(host='0.0.0.0', port=5002, debug=False)
     except Exception as e:
 
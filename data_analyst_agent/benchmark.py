@@ -0,0 +1,409 @@
+import argparse
+import glob
+import http.server
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Replays must exercise the execution path, not the caches, and must not touch the real workspace.
+BENCHMARK_TMP_DIR = tempfile.mkdtemp(prefix="benchmark_")
+os.environ.setdefault("PLAN_CACHE_ENABLED", "0")
+os.environ.setdefault("WEB_CACHE_ENABLED", "0")
+os.environ.setdefault("STEP_CACHE_ENABLED", "0")
+os.environ.setdefault("WORKSPACE_DIR", os.path.join(BENCHMARK_TMP_DIR, "workspaces"))
+# Every replay needs its trace, and the recorded diagnostics it reads from must not be pruned or mixed in.
+os.environ["DIAGNOSTICS_DIR"] = os.path.join(BENCHMARK_TMP_DIR, "diagnostics")
+os.environ["DIAGNOSTICS_SAMPLE_RATE"] = "1"
+
+import app as agent_app
+from diagnostics import get_diagnostics_store, read_diagnostics_file
+from logger_setup import log
+from sandbox_pool import get_sandbox_pool
+from tools import build_docker_image
+from tracing import peak_rss_bytes, TRACE_FILE
+
+SCENARIOS_DIR = "test_case_scenarios"
+RECORDED_DIAGNOSTICS_DIR = "diagnostics"
+FIXTURES_DIR = "benchmark_fixtures"
+FIXTURE_URLS_FILE = "urls.json"
+BASELINE_FILE = "benchmark_baseline.json"
+SCENARIO_SKIP_FILES = ("questions.txt", "response.json", "promptfoo.yaml")
+NETWORK_MARKERS = ("s3://", "http://", "https://", "httpfs")
+PERCENTILES = (50, 90, 99)
+REPLAY_TAG = re.compile(r"\[replay:(\w+)\]")
+
+
+class Replay:
+    def __init__(self, replay_id: str, scenario: str, source: str, questions: str, plan: list, uploads: list):
+        self.id = replay_id
+        self.scenario = scenario
+        self.source = source
+        self.questions = questions
+        self.plan = plan
+        self.uploads = uploads
+
+    @property
+    def name(self) -> str:
+        return f"{self.scenario}/{self.source}"
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def load_scenarios(scenarios_dir: str) -> dict:
+    scenarios = {}
+    for scenario_dir in sorted(glob.glob(os.path.join(scenarios_dir, "*"))):
+        questions_path = os.path.join(scenario_dir, "questions.txt")
+        if not os.path.isfile(questions_path):
+            continue
+        with open(questions_path, "r", encoding="utf-8") as f:
+            questions = f.read()
+        uploads = [(name, os.path.join(scenario_dir, name)) for name in sorted(os.listdir(scenario_dir))
+                   if name not in SCENARIO_SKIP_FILES]
+        scenarios[os.path.basename(scenario_dir)] = {"questions": questions, "uploads": uploads}
+    return scenarios
+
+
+def referenced_files(plan: list) -> set:
+    names = set()
+    for step in plan:
+        code = step.get("args", {}).get("code") or ""
+        names.update(re.findall(r"['\"]([\w.-]+\.(?:csv|xlsx))['\"]", code))
+    return names
+
+
+def skip_reason(plan: list, fixture_urls: dict):
+    for step in plan:
+        args = step.get("args", {})
+        if step.get("tool") == "web_scraper" and args.get("url") not in fixture_urls:
+            return f"no fixture for {args.get('url')}"
+        if step.get("tool") == "python_interpreter" and any(m in (args.get("code") or "") for m in NETWORK_MARKERS):
+            return "code needs network access"
+    return None
+
+
+def load_workload(scenarios_dir: str, diagnostics_dir: str, fixture_urls: dict, base_url: str,
+                  only: list = None) -> tuple[list, list]:
+    scenarios = load_scenarios(scenarios_dir)
+    by_questions = {normalize_text(s["questions"]): name for name, s in scenarios.items()}
+    replays, skipped = [], []
+    for folder in sorted(glob.glob(os.path.join(diagnostics_dir, "*", ""))):
+        folder = os.path.dirname(folder)
+        source = os.path.basename(folder)
+        questions = read_diagnostics_file(folder, "01_request_questions.txt")
+        plan_text = read_diagnostics_file(folder, "03_gemini_parsed_plan.json")
+        if questions is None or plan_text is None:
+            continue
+        scenario = by_questions.get(normalize_text(questions))
+        if scenario is None or (only and scenario not in only):
+            continue
+        plan = json.loads(plan_text)
+
+        reason = skip_reason(plan, fixture_urls)
+        if reason:
+            skipped.append((f"{scenario}/{source}", reason))
+            continue
+
+        for step in plan:
+            url = step.get("args", {}).get("url")
+            if step.get("tool") == "web_scraper" and url:
+                step["args"]["url"] = f"{base_url}/{fixture_urls[url]}"
+
+        uploads = list(scenarios[scenario]["uploads"])
+        data_uploads = [(name, path) for name, path in uploads if name.lower().endswith(('.csv', '.xlsx'))]
+        uploaded_names = {name for name, _ in uploads}
+        # Older plans read a single upload as 'data.csv'; replay it under that name too.
+        for name in referenced_files(plan) - uploaded_names:
+            if len(data_uploads) == 1:
+                uploads.append((name, data_uploads[0][1]))
+        replays.append(Replay(f"r{len(replays)}", scenario, source, questions, plan, uploads))
+    return replays, skipped
+
+
+class ReplayPlanner:
+    def __init__(self, replays: list, latency: float = 0.0, chunk_size: int = 256):
+        self.plans = {replay.id: json.dumps(replay.plan, indent=4) for replay in replays}
+        self.latency = latency
+        self.chunk_size = chunk_size
+
+    def _plan_text(self, contents) -> str:
+        match = REPLAY_TAG.search(contents[0])
+        if match is None:
+            raise ValueError("Prompt does not carry a replay tag.")
+        return self.plans[match.group(1)]
+
+    def generate_content(self, contents, **kwargs):
+        text = self._plan_text(contents)
+        time.sleep(self.latency)
+        return type("ReplayResponse", (), {"text": text})()
+
+    def generate_content_stream(self, contents, **kwargs):
+        text = self._plan_text(contents)
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        for chunk in chunks:
+            time.sleep(self.latency / max(len(chunks), 1))
+            yield chunk
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fixture_server(directory: str) -> http.server.ThreadingHTTPServer:
+    handler = lambda *args, **kwargs: QuietHandler(*args, directory=directory, **kwargs)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="benchmark-fixtures").start()
+    return server
+
+
+_address_lock = threading.Lock()
+_address_counter = 0
+
+
+def next_client_address() -> str:
+    # Diagnostics folders start with the client address, so a unique address lets each replay find its own trace.
+    global _address_counter
+    with _address_lock:
+        _address_counter += 1
+        n = _address_counter
+    return f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+
+def load_trace(client_address: str):
+    store = get_diagnostics_store()
+    for folder in glob.glob(os.path.join(store.diagnostics_dir, f"{client_address}_*")):
+        trace_text = read_diagnostics_file(folder, TRACE_FILE)
+        if trace_text is not None:
+            return json.loads(trace_text)
+    return None
+
+
+def run_replay(replay: Replay) -> dict:
+    client_address = next_client_address()
+    data = {"questions.txt": (io.BytesIO(f"{replay.questions}\n\n[replay:{replay.id}]".encode("utf-8")),
+                              "questions.txt")}
+    handles = []
+    for name, path in replay.uploads:
+        handle = open(path, "rb")
+        handles.append(handle)
+        data[name] = (handle, name)
+
+    start = time.perf_counter()
+    try:
+        response = agent_app.app.test_client().post("/api/", data=data, content_type="multipart/form-data",
+                                                    environ_base={"REMOTE_ADDR": client_address})
+    finally:
+        for handle in handles:
+            handle.close()
+    latency = time.perf_counter() - start
+
+    result = {"replay": replay.name, "scenario": replay.scenario, "status": response.status_code,
+              "latency": latency, "client_address": client_address, "phases": {}, "worker_peak_rss_bytes": None}
+    if response.status_code != 200:
+        error = (response.get_json(silent=True) or {}).get("error") or f"HTTP {response.status_code}"
+        result["error"] = error.strip().splitlines()[-1][:300]
+    return result
+
+
+def attach_trace(result: dict):
+    trace = load_trace(result["client_address"])
+    for span in (trace or {}).get("spans", []):
+        phase = span["name"] if not span.get("tool") else f"{span['name']}:{span['tool']}"
+        result["phases"].setdefault(phase, []).append(span["duration"])
+        worker_rss = span.get("attrs", {}).get("worker_peak_rss_bytes")
+        if worker_rss:
+            result["worker_peak_rss_bytes"] = max(result["worker_peak_rss_bytes"] or 0, worker_rss)
+
+
+def percentiles(values: list) -> dict:
+    ordered = sorted(values)
+    if not ordered:
+        return {f"p{p}": None for p in PERCENTILES}
+    # Nearest-rank percentiles; with a handful of iterations anything fancier is noise.
+    return {f"p{p}": ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))] for p in PERCENTILES}
+
+
+def summarize(results: list, wall_clock: float, concurrency: int) -> dict:
+    scenarios = {}
+    phases = {}
+    for result in results:
+        entry = scenarios.setdefault(result["replay"], {"latencies": [], "errors": 0, "last_error": None})
+        entry["latencies"].append(result["latency"])
+        if result["status"] != 200:
+            entry["errors"] += 1
+            entry["last_error"] = result.get("error")
+        for phase, durations in result["phases"].items():
+            phases.setdefault(phase, []).extend(durations)
+
+    worker_rss = [r["worker_peak_rss_bytes"] for r in results if r["worker_peak_rss_bytes"]]
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": sum(1 for r in results if r["status"] != 200),
+        "wall_clock_seconds": wall_clock,
+        "throughput_rps": len(results) / wall_clock if wall_clock else 0.0,
+        "latency": percentiles([r["latency"] for r in results]),
+        "scenarios": {name: {**percentiles(entry["latencies"]), "runs": len(entry["latencies"]),
+                             "errors": entry["errors"], "last_error": entry["last_error"]}
+                      for name, entry in sorted(scenarios.items())},
+        "phases": {phase: {**percentiles(durations), "count": len(durations)}
+                   for phase, durations in sorted(phases.items())},
+        "memory": {"server_peak_rss_bytes": peak_rss_bytes(),
+                   "worker_peak_rss_bytes": max(worker_rss) if worker_rss else None},
+    }
+
+
+def run_level(replays: list, iterations: int, concurrency: int) -> dict:
+    tasks = [replay for _ in range(iterations) for replay in replays]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="benchmark") as executor:
+        results = list(executor.map(run_replay, tasks))
+    wall_clock = time.perf_counter() - start
+    # Diagnostics are written in the background. Waiting for them inside the timed run would count every
+    # replay's trace write against throughput, so traces are only collected once the clock has stopped.
+    get_diagnostics_store().flush()
+    for result in results:
+        attach_trace(result)
+    return summarize(results, wall_clock, concurrency)
+
+
+def format_seconds(value) -> str:
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+
+def print_report(level: dict):
+    print(f"\n=== concurrency {level['concurrency']}: {level['requests']} requests, {level['errors']} errors, "
+          f"{level['throughput_rps']:.2f} req/s over {level['wall_clock_seconds']:.2f}s")
+    print(f"  overall       p50 {format_seconds(level['latency']['p50'])}  p90 {format_seconds(level['latency']['p90'])}"
+          f"  p99 {format_seconds(level['latency']['p99'])}")
+    for name, stats in level["scenarios"].items():
+        errors = f"  errors {stats['errors']}: {stats['last_error']}" if stats["errors"] else ""
+        print(f"  {name:<40} p50 {format_seconds(stats['p50'])}  p90 {format_seconds(stats['p90'])}{errors}")
+    for phase, stats in level["phases"].items():
+        print(f"  [{phase:<38}] p50 {format_seconds(stats['p50'])}  p90 {format_seconds(stats['p90'])}"
+              f"  n={stats['count']}")
+    memory = level["memory"]
+    print(f"  memory: server peak RSS {memory['server_peak_rss_bytes']}, "
+          f"worker peak RSS {memory['worker_peak_rss_bytes']}")
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    for level in results["levels"]:
+        base = baseline_levels.get(level["concurrency"])
+        if base is None:
+            continue
+        if level["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"concurrency {level['concurrency']}: throughput {level['throughput_rps']:.2f} req/s "
+                               f"vs baseline {base['throughput_rps']:.2f} req/s")
+        for name, stats in level["scenarios"].items():
+            base_stats = base["scenarios"].get(name)
+            if not base_stats or stats["p50"] is None or base_stats.get("p50") is None:
+                continue
+            if stats["p50"] > base_stats["p50"] * (1 + tolerance):
+                regressions.append(f"concurrency {level['concurrency']}: {name} p50 {format_seconds(stats['p50'])} "
+                                   f"vs baseline {format_seconds(base_stats['p50'])}")
+            if stats["errors"] > base_stats.get("errors", 0):
+                regressions.append(f"concurrency {level['concurrency']}: {name} has {stats['errors']} error(s) "
+                                   f"vs {base_stats.get('errors', 0)} in the baseline")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded plans through the execution path offline.")
+    parser.add_argument("--iterations", type=int, default=3, help="Measured runs of each replay per level.")
+    parser.add_argument("--concurrency", default="1,4", help="Comma-separated concurrency levels.")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured runs of each replay before measuring.")
+    parser.add_argument("--planner-latency", type=float, default=0.0,
+                        help="Seconds the stubbed planner takes to return a plan.")
+    parser.add_argument("--scenario", action="append", help="Only replay these scenarios (repeatable).")
+    parser.add_argument("--scenarios-dir", default=SCENARIOS_DIR)
+    parser.add_argument("--diagnostics-dir", default=RECORDED_DIAGNOSTICS_DIR)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed relative slowdown before a result counts as a regression.")
+    parser.add_argument("--output", help="Write the full results as JSON to this file.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the agent's INFO logging on.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if not args.verbose:
+        log.setLevel(logging.WARNING)
+    with open(os.path.join(FIXTURES_DIR, FIXTURE_URLS_FILE), "r", encoding="utf-8") as f:
+        fixture_urls = json.load(f)
+    server = start_fixture_server(FIXTURES_DIR)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    replays, skipped = load_workload(args.scenarios_dir, args.diagnostics_dir, fixture_urls, base_url,
+                                     only=args.scenario)
+    for name, reason in skipped:
+        print(f"Skipping {name}: {reason}")
+    if not replays:
+        print("No recorded plans to replay.")
+        return 1
+
+    agent_app.model_pool = ReplayPlanner(replays, latency=args.planner_latency)
+    sandbox_pool = get_sandbox_pool()
+    if sandbox_pool.backend == "docker":
+        build_docker_image()
+    sandbox_pool.start()
+
+    log.info(f"Replaying {len(replays)} recorded plan(s) from {len({r.scenario for r in replays})} scenario(s).")
+    for _ in range(args.warmup):
+        for replay in replays:
+            run_replay(replay)
+    get_diagnostics_store().flush()
+
+    results = {"created_at": time.time(), "iterations": args.iterations,
+               "planner_latency": args.planner_latency, "backend": sandbox_pool.backend,
+               "replays": [replay.name for replay in replays], "levels": []}
+    for concurrency in [int(c) for c in args.concurrency.split(",") if c.strip()]:
+        level = run_level(replays, args.iterations, concurrency)
+        results["levels"].append(level)
+        print_report(level)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+    exit_code = 0
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+        print(f"\nSaved baseline to {args.baseline}.")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.baseline}:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            exit_code = 1
+        else:
+            print(f"\nNo regressions against {args.baseline} (tolerance {args.tolerance:.0%}).")
+    else:
+        print(f"\nNo baseline at {args.baseline}. Run with --save-baseline to create one.")
+
+    server.shutdown()
+    sandbox_pool.shutdown()
+    shutil.rmtree(BENCHMARK_TMP_DIR, ignore_errors=True)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
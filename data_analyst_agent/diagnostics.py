@@ -0,0 +1,239 @@
+import datetime
+import gzip
+import json
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+import time
+from logger_setup import log
+from tracing import span, TRACE_FILE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DIAGNOSTICS_ENABLED = os.environ.get("DIAGNOSTICS_ENABLED", "1") == "1"
+DIAGNOSTICS_DIR = os.environ.get("DIAGNOSTICS_DIR", "diagnostics")
+# Fraction of successful requests whose diagnostics are kept. Failed requests are always kept.
+DIAGNOSTICS_SAMPLE_RATE = float(os.environ.get("DIAGNOSTICS_SAMPLE_RATE", "1.0"))
+# "none", "gzip" or "zstd". zstd needs the zstandard package and falls back to gzip without it.
+DIAGNOSTICS_COMPRESSION = os.environ.get("DIAGNOSTICS_COMPRESSION", "none")
+DIAGNOSTICS_MAX_AGE_SECONDS = float(os.environ.get("DIAGNOSTICS_MAX_AGE_SECONDS", str(30 * 24 * 3600)))
+DIAGNOSTICS_MAX_BYTES = int(os.environ.get("DIAGNOSTICS_MAX_BYTES", str(1024 * 1024 * 1024)))
+DIAGNOSTICS_QUEUE_SIZE = int(os.environ.get("DIAGNOSTICS_QUEUE_SIZE", "256"))
+DIAGNOSTICS_PRUNE_INTERVAL_SECONDS = 60
+COMPRESSED_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+# Only folders written by the store (<ip>_<timestamp>_<request id>) are pruned. Anything else in the directory,
+# such as the recorded plans benchmark.py replays, is left alone.
+MANAGED_FOLDER_PATTERN = re.compile(r"^.+_\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}_[0-9a-f]{32}$")
+
+
+def compress(content: bytes, compression: str) -> bytes:
+    if compression == "gzip":
+        return gzip.compress(content, compresslevel=6)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(content)
+    return content
+
+
+def read_diagnostics_file(folder: str, filename: str):
+    # Reads a diagnostics file whichever way it was stored. Returns None if it is missing.
+    path = os.path.join(folder, filename)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read().decode("utf-8")
+    if os.path.exists(path + COMPRESSED_SUFFIXES["gzip"]):
+        with gzip.open(path + COMPRESSED_SUFFIXES["gzip"], "rb") as f:
+            return f.read().decode("utf-8")
+    if os.path.exists(path + COMPRESSED_SUFFIXES["zstd"]) and zstandard is not None:
+        with open(path + COMPRESSED_SUFFIXES["zstd"], "rb") as f:
+            return zstandard.ZstdDecompressor().decompressobj().decompress(f.read()).decode("utf-8")
+    return None
+
+
+def folder_size(path: str) -> int:
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class DiagnosticsRecord:
+    def __init__(self, store, folder_name: str, sampled: bool):
+        self.store = store
+        self.folder_name = folder_name
+        self.sampled = sampled
+        self.files = {}
+
+    @property
+    def folder(self) -> str:
+        return os.path.join(self.store.diagnostics_dir, self.folder_name)
+
+    def add(self, filename: str, content: str):
+        # Files are only buffered here. They are written by the background writer once the request finishes.
+        self.files[filename] = content
+
+    def close(self, http_status: int, trace=None):
+        if trace is not None:
+            self.files[TRACE_FILE] = json.dumps(trace.to_dict(), indent=4, default=str)
+        if self.sampled or http_status >= 400:
+            self.store.submit(self)
+        else:
+            self.store.record_sampled_out()
+        self.files = {}
+
+
+class DiagnosticsStore:
+    def __init__(self, diagnostics_dir: str = DIAGNOSTICS_DIR, enabled: bool = DIAGNOSTICS_ENABLED,
+                 sample_rate: float = DIAGNOSTICS_SAMPLE_RATE, compression: str = DIAGNOSTICS_COMPRESSION,
+                 max_age_seconds: float = DIAGNOSTICS_MAX_AGE_SECONDS, max_bytes: int = DIAGNOSTICS_MAX_BYTES,
+                 queue_size: int = DIAGNOSTICS_QUEUE_SIZE):
+        self.diagnostics_dir = diagnostics_dir
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        if compression == "zstd" and zstandard is None:
+            log.warning("DIAGNOSTICS_COMPRESSION is zstd but zstandard is not installed. Using gzip instead.")
+            compression = "gzip"
+        if compression not in ("none", *COMPRESSED_SUFFIXES):
+            log.warning(f"Unknown DIAGNOSTICS_COMPRESSION '{compression}'. Storing diagnostics uncompressed.")
+            compression = "none"
+        self.compression = compression
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.bytes_written = 0
+        self.pruned = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._last_prune = 0.0
+        self._thread = None
+        if enabled:
+            os.makedirs(diagnostics_dir, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name="diagnostics-writer", daemon=True)
+            self._thread.start()
+
+    def start_request(self, remote_addr: str, request_id: str) -> DiagnosticsRecord:
+        ip_address = (remote_addr or "unknown").replace(":", "_")
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        # The request id keeps concurrent requests from the same address in the same second apart.
+        sampled = self.enabled and random.random() < self.sample_rate
+        return DiagnosticsRecord(self, f"{ip_address}_{timestamp}_{request_id}", sampled)
+
+    def submit(self, record: DiagnosticsRecord):
+        if not self.enabled:
+            return
+        try:
+            # Never block the request path: under sustained load a full queue drops diagnostics instead.
+            self._queue.put_nowait((record.folder, dict(record.files)))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            log.warning(f"Diagnostics queue is full. Dropping diagnostics for {record.folder_name}.")
+
+    def record_sampled_out(self):
+        with self._lock:
+            self.sampled_out += 1
+
+    def flush(self):
+        if self._thread is not None:
+            self._queue.join()
+
+    def _run(self):
+        self._prune()
+        while True:
+            try:
+                folder, files = self._queue.get(timeout=DIAGNOSTICS_PRUNE_INTERVAL_SECONDS)
+            except queue.Empty:
+                self._prune()
+                continue
+            try:
+                self._write(folder, files)
+                if time.time() - self._last_prune >= DIAGNOSTICS_PRUNE_INTERVAL_SECONDS:
+                    self._prune()
+            except Exception:
+                log.warning(f"Could not write diagnostics to {folder}.", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, folder: str, files: dict):
+        suffix = COMPRESSED_SUFFIXES.get(self.compression, "")
+        with span("diagnostics_write", compression=self.compression) as write_span:
+            os.makedirs(folder, exist_ok=True)
+            total = 0
+            for filename, content in files.items():
+                payload = compress(content.encode("utf-8"), self.compression)
+                with open(os.path.join(folder, filename + suffix), "wb") as f:
+                    f.write(payload)
+                total += len(payload)
+            write_span.add_bytes(total)
+        with self._lock:
+            self.written += 1
+            self.bytes_written += total
+        log.info(f"Wrote diagnostics folder: {folder} ({len(files)} files, {total} bytes)")
+
+    def _prune(self):
+        self._last_prune = time.time()
+        try:
+            folders = []
+            for name in os.listdir(self.diagnostics_dir):
+                path = os.path.join(self.diagnostics_dir, name)
+                if MANAGED_FOLDER_PATTERN.match(name) and os.path.isdir(path):
+                    folders.append((os.path.getmtime(path), path))
+        except OSError:
+            log.warning(f"Could not list diagnostics folder '{self.diagnostics_dir}'.", exc_info=True)
+            return
+
+        expired, kept = [], []
+        for mtime, path in sorted(folders):
+            if self.max_age_seconds > 0 and self._last_prune - mtime > self.max_age_seconds:
+                expired.append(path)
+            else:
+                kept.append((path, folder_size(path)))
+        total_bytes = sum(size for _, size in kept)
+        # Oldest folders go first once the directory is over its size budget.
+        while self.max_bytes > 0 and total_bytes > self.max_bytes and kept:
+            path, size = kept.pop(0)
+            expired.append(path)
+            total_bytes -= size
+        for path in expired:
+            shutil.rmtree(path, ignore_errors=True)
+        if expired:
+            with self._lock:
+                self.pruned += len(expired)
+            log.info(f"Pruned {len(expired)} diagnostics folder(s). {total_bytes} bytes remain.")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "sample_rate": self.sample_rate,
+                "compression": self.compression,
+                "queued": self._queue.qsize(),
+                "written": self.written,
+                "dropped": self.dropped,
+                "sampled_out": self.sampled_out,
+                "bytes_written": self.bytes_written,
+                "pruned": self.pruned,
+            }
+
+
+_diagnostics_store = None
+_diagnostics_store_lock = threading.Lock()
+
+
+def get_diagnostics_store() -> DiagnosticsStore:
+    global _diagnostics_store
+    with _diagnostics_store_lock:
+        if _diagnostics_store is None:
+            _diagnostics_store = DiagnosticsStore()
+        return _diagnostics_store
@@ -0,0 +1,138 @@
+import base64
+import io
+import os
+import re
+from logger_setup import log
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Uploaded images larger than this (in either dimension) are downscaled before they are sent to the model.
+IMAGE_MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", "1536"))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+# Data URIs in the final answer longer than this are re-encoded. 0 leaves them untouched.
+IMAGE_OUTPUT_MAX_BYTES = int(os.environ.get("IMAGE_OUTPUT_MAX_BYTES", "100000"))
+# Formats an answer image may be converted to. Images are only converted to a format other than their own
+# when it is listed here, so a PNG stays a PNG unless an operator opts in to WebP.
+IMAGE_OUTPUT_FORMATS = [f.strip() for f in os.environ.get("IMAGE_OUTPUT_FORMATS", "png").split(",") if f.strip()]
+IMAGE_WEBP_QUALITY = 80
+IMAGE_OUTPUT_DOWNSCALE_STEPS = 8
+IMAGE_OUTPUT_DOWNSCALE_FACTOR = 0.75
+OUTPUT_MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+ORIENTATION_TAG = 0x0112
+DATA_URI_PATTERN = re.compile(r"^data:image/(png|jpe?g|webp);base64,(.+)$", re.DOTALL)
+
+
+def mime_type_for(file_name: str) -> str:
+    extension = file_name.lower().rsplit('.', 1)[-1]
+    return "image/jpeg" if extension in ("jpg", "jpeg") else f"image/{extension}"
+
+
+def prepare_input_image(content: bytes, file_name: str) -> tuple[bytes, str]:
+    mime_type = mime_type_for(file_name)
+    if Image is None:
+        return content, mime_type
+    try:
+        with Image.open(io.BytesIO(content)) as source:
+            source.load()
+            source_format = source.format
+            orientation = source.getexif().get(ORIENTATION_TAG, 1)
+            # Re-encoding drops EXIF, so a rotated phone photo must be turned upright first.
+            image = ImageOps.exif_transpose(source)
+            resized = 0 < IMAGE_MAX_DIMENSION < max(image.size)
+            if resized:
+                image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+            buffer = io.BytesIO()
+            if source_format == "JPEG":
+                image.convert("RGB").save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+            else:
+                image.save(buffer, format="PNG", optimize=True)
+                source_format = "PNG"
+    except Exception as e:
+        log.warning(f"Could not re-encode image '{file_name}' ({e}). Sending it unchanged.")
+        return content, mime_type
+    encoded = buffer.getvalue()
+    # An already well-compressed image is kept as is, unless it had to be downscaled or rotated.
+    if not resized and orientation == 1 and len(encoded) >= len(content):
+        return content, Image.MIME.get(source_format, mime_type)
+    return encoded, Image.MIME[source_format]
+
+
+def encode_output_image(image, output_format: str) -> bytes:
+    buffer = io.BytesIO()
+    if output_format == "png":
+        # Charts use few colours, so a 256-colour palette is usually indistinguishable from the original.
+        image.convert("RGBA").quantize(colors=256, method=Image.Quantize.FASTOCTREE).save(
+            buffer, format="PNG", optimize=True)
+    elif output_format == "jpeg":
+        image.convert("RGB").save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    elif output_format == "webp":
+        image.save(buffer, format="WEBP", quality=IMAGE_WEBP_QUALITY)
+    else:
+        raise ValueError(f"Unsupported image output format: {output_format}")
+    return buffer.getvalue()
+
+
+def shrink_data_uri(data_uri: str, max_bytes: int = IMAGE_OUTPUT_MAX_BYTES) -> str:
+    match = DATA_URI_PATTERN.match(data_uri)
+    if match is None or Image is None or max_bytes <= 0 or len(data_uri) <= max_bytes:
+        return data_uri
+    try:
+        image = Image.open(io.BytesIO(base64.b64decode(match.group(2))))
+        image.load()
+    except Exception as e:
+        log.warning(f"Could not decode an image in the final answer ({e}). Leaving it unchanged.")
+        return data_uri
+
+    # The source format comes first, so every downscaled size is tried in it before any other format.
+    source_format = "jpeg" if match.group(1) in ("jpg", "jpeg") else match.group(1)
+    formats = [source_format] + [f for f in IMAGE_OUTPUT_FORMATS if f != source_format and f in OUTPUT_MIME_TYPES]
+    smallest = data_uri
+    for output_format in formats:
+        candidate = fit_image(image, output_format, max_bytes)
+        if candidate and len(candidate) < len(smallest):
+            smallest = candidate
+        if candidate and len(candidate) <= max_bytes:
+            return candidate
+    log.warning(f"Could not fit a final answer image into {max_bytes} bytes. Returning {len(smallest)} bytes.")
+    return smallest
+
+
+def fit_image(image, output_format: str, max_bytes: int) -> str:
+    # Returns the first downscaled encoding within the budget, or the smallest one if none fits.
+    smallest = None
+    for _ in range(IMAGE_OUTPUT_DOWNSCALE_STEPS):
+        try:
+            encoded = encode_output_image(image, output_format)
+        except Exception as e:
+            log.warning(f"Could not encode the final answer image as {output_format} ({e}).")
+            break
+        candidate = f"data:{OUTPUT_MIME_TYPES[output_format]};base64,{base64.b64encode(encoded).decode('utf-8')}"
+        if smallest is None or len(candidate) < len(smallest):
+            smallest = candidate
+        if len(candidate) <= max_bytes:
+            break
+        width, height = image.size
+        image = image.resize((max(1, int(width * IMAGE_OUTPUT_DOWNSCALE_FACTOR)),
+                              max(1, int(height * IMAGE_OUTPUT_DOWNSCALE_FACTOR))), Image.LANCZOS)
+    return smallest or ""
+
+
+def optimize_answer_images(value, max_bytes: int = IMAGE_OUTPUT_MAX_BYTES) -> tuple[object, list]:
+    # Returns the answer with every image data URI re-encoded, and the (before, after) size of each one.
+    sizes = []
+
+    def visit(item):
+        if isinstance(item, dict):
+            return {key: visit(child) for key, child in item.items()}
+        if isinstance(item, list):
+            return [visit(child) for child in item]
+        if isinstance(item, str) and DATA_URI_PATTERN.match(item):
+            optimized = shrink_data_uri(item, max_bytes)
+            sizes.append((len(item), len(optimized)))
+            return optimized
+        return item
+
+    return visit(value), sizes
@@ -0,0 +1,200 @@
+import os
+import re
+import shutil
+import uuid
+import pandas as pd
+from werkzeug.utils import secure_filename
+from logger_setup import log
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+WORKSPACE_DIR = os.environ.get("WORKSPACE_DIR", "workspaces")
+INGEST_SAMPLE_ROWS = int(os.environ.get("INGEST_SAMPLE_ROWS", "1000"))
+CSV_TAIL_SAMPLE_BYTES = 64 * 1024
+DATA_EXTENSIONS = ('.csv', '.xlsx')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# CSV uploads at least this large are converted to Parquet and queried through DuckDB instead of pandas.
+LARGE_DATA_THRESHOLD_BYTES = int(os.environ.get("LARGE_DATA_THRESHOLD_BYTES", str(100 * 1024 * 1024)))
+LARGE_DATA_SAMPLE_ROWS = int(os.environ.get("LARGE_DATA_SAMPLE_ROWS", "5"))
+
+
+def round_estimate(value: float) -> int:
+    # Two significant figures, so re-uploads of slightly different sizes describe (and cache) the same way.
+    if value < 100:
+        return int(value)
+    magnitude = 10 ** (len(str(int(value))) - 2)
+    return int(round(value / magnitude) * magnitude)
+
+
+class UploadedDataset:
+    def __init__(self, name: str, path: str, columns: list, dtypes: dict, row_estimate: int, exact_rows: bool):
+        self.name = name
+        self.path = path
+        self.columns = columns
+        self.dtypes = dtypes
+        self.row_estimate = row_estimate
+        self.exact_rows = exact_rows
+        self.size_bytes = os.path.getsize(path)
+        # Files copied into the sandbox for each step, and DuckDB views to create over them.
+        self.sandbox_files = {name: path}
+        self.tables = {}
+
+    def describe(self) -> str:
+        rows = f"{self.row_estimate} rows" if self.exact_rows else f"about {self.row_estimate} rows"
+        return f"a data file named '{self.name}' ({rows}) with columns and inferred dtypes: {self.dtypes}"
+
+
+class LargeDataset(UploadedDataset):
+    def __init__(self, name: str, path: str, parquet_path: str, table_name: str, dtypes: dict,
+                 row_count: int, column_stats: list, sample_rows: list):
+        super().__init__(name, path, list(dtypes), dtypes, row_count, True)
+        self.parquet_path = parquet_path
+        self.table_name = table_name
+        self.column_stats = column_stats
+        self.sample_rows = sample_rows
+        parquet_name = os.path.basename(parquet_path)
+        self.sandbox_files = {parquet_name: parquet_path}
+        self.tables = {table_name: parquet_name}
+
+    def describe(self) -> str:
+        return (f"a large data file named '{self.name}' ({self.row_estimate} rows, {self.size_bytes} bytes) that is "
+                f"NOT loaded into pandas. Query it as the DuckDB table `{self.table_name}` through the ready "
+                f"connection `con`. Column summary: {self.column_stats}. Sample rows: {self.sample_rows}")
+
+
+def create_workspace() -> str:
+    workspace = os.path.join(WORKSPACE_DIR, uuid.uuid4().hex)
+    os.makedirs(workspace)
+    return workspace
+
+
+def remove_workspace(workspace: str):
+    shutil.rmtree(workspace, ignore_errors=True)
+
+
+def stored_upload_name(field_name: str, index: int, used: set) -> str:
+    extension = secure_filename(os.path.splitext(field_name)[1].lstrip("."))
+    extension = f".{extension}" if extension else ""
+    stored_name = secure_filename(field_name)
+    # Non-ASCII names can lose everything but the extension ('数据.csv' -> 'csv'), and the extension decides how
+    # the upload is read, so such names fall back to a generated one that keeps it.
+    if not stored_name or not stored_name.endswith(extension):
+        stored_name = f"upload_{index}{extension}"
+    # Different field names can sanitize to the same name ('a b.csv' and 'a_b.csv'); neither may overwrite the other.
+    stem, suffix = os.path.splitext(stored_name)
+    counter = 1
+    while stored_name in used:
+        stored_name = f"{stem}_{counter}{suffix}"
+        counter += 1
+    used.add(stored_name)
+    return stored_name
+
+
+def spool_uploads(files, workspace: str) -> list:
+    uploads = []
+    used_names = set()
+    for i, (field_name, file_storage) in enumerate(files):
+        stored_name = stored_upload_name(field_name, i, used_names)
+        path = os.path.join(workspace, stored_name)
+        # FileStorage.save copies in fixed-size chunks, so the upload never has to fit in memory.
+        file_storage.save(path)
+        if stored_name != field_name:
+            log.info(f"Stored upload '{field_name}' as '{stored_name}'.")
+        uploads.append((stored_name, path))
+    return uploads
+
+
+def estimate_csv_rows(path: str, sample: pd.DataFrame, sample_rows: int) -> tuple[int, bool]:
+    if len(sample) < sample_rows:
+        return len(sample), True
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header = f.readline()
+        sample_bytes = sum(len(f.readline()) for _ in range(sample_rows))
+        # Lines at the end of a file are often longer (growing ids, dates), so average over a tail block as well.
+        f.seek(max(file_size - CSV_TAIL_SAMPLE_BYTES, f.tell()))
+        tail = f.read()
+    line_bytes = (sample_bytes + len(tail)) / (sample_rows + max(tail.count(b"\n"), 1))
+    return round_estimate((file_size - len(header)) / max(line_bytes, 1)), False
+
+
+def estimate_excel_rows(path: str, sample: pd.DataFrame, sample_rows: int) -> tuple[int, bool]:
+    if len(sample) < sample_rows:
+        return len(sample), True
+    try:
+        import openpyxl
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        max_row = workbook.active.max_row
+        workbook.close()
+        if max_row:
+            return round_estimate(max_row - 1), False
+    except Exception:
+        log.warning(f"Could not read the row count of '{path}'.", exc_info=True)
+    return sample_rows, False
+
+
+def sniff_dataset(name: str, path: str, sample_rows: int = INGEST_SAMPLE_ROWS) -> UploadedDataset:
+    if name.lower().endswith('.xlsx'):
+        sample = pd.read_excel(path, nrows=sample_rows)
+        row_estimate, exact_rows = estimate_excel_rows(path, sample, sample_rows)
+    else:
+        sample = pd.read_csv(path, nrows=sample_rows)
+        row_estimate, exact_rows = estimate_csv_rows(path, sample, sample_rows)
+    dtypes = sample.dtypes.astype(str).to_dict()
+    log.info(f"Sniffed '{name}': {len(dtypes)} columns, {'' if exact_rows else '~'}{row_estimate} rows.")
+    return UploadedDataset(name, path, sample.columns.tolist(), dtypes, row_estimate, exact_rows)
+
+
+
+def sql_string(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def table_name_for(file_name: str) -> str:
+    table_name = re.sub(r'\W', '_', os.path.splitext(file_name)[0]).lower()
+    return table_name if table_name[:1].isalpha() else f"t_{table_name}"
+
+
+def convert_large_dataset(name: str, path: str) -> LargeDataset:
+    parquet_path = os.path.splitext(path)[0] + ".parquet"
+    source = f"read_parquet({sql_string(parquet_path)})"
+    con = duckdb.connect()
+    try:
+        # DuckDB streams the CSV into Parquet, so the upload is never materialized as a DataFrame.
+        con.execute(f"COPY (SELECT * FROM read_csv_auto({sql_string(path)})) "
+                    f"TO {sql_string(parquet_path)} (FORMAT parquet)")
+        row_count = con.execute(f"SELECT count(*) FROM {source}").fetchone()[0]
+        summary = con.execute(f"SUMMARIZE SELECT * FROM {source}")
+        summary_columns = [column[0] for column in summary.description]
+        column_stats, dtypes = [], {}
+        for row in summary.fetchall():
+            stats = dict(zip(summary_columns, row))
+            dtypes[stats["column_name"]] = stats["column_type"]
+            null_percentage = float(stats["null_percentage"] or 0)
+            column_stats.append({
+                "column": stats["column_name"],
+                "type": stats["column_type"],
+                "nulls": int(round(row_count * null_percentage / 100)),
+                "min": stats["min"],
+                "max": stats["max"],
+            })
+        sample = con.execute(f"SELECT * FROM {source} LIMIT {LARGE_DATA_SAMPLE_ROWS}")
+        sample_columns = [column[0] for column in sample.description]
+        sample_rows = [{column: None if value is None else str(value) for column, value in zip(sample_columns, row)}
+                       for row in sample.fetchall()]
+    finally:
+        con.close()
+    log.info(f"Converted '{name}' to Parquet: {row_count} rows, {len(dtypes)} columns, "
+             f"{os.path.getsize(path)} -> {os.path.getsize(parquet_path)} bytes.")
+    return LargeDataset(name, path, parquet_path, table_name_for(name), dtypes, row_count, column_stats, sample_rows)
+
+
+def load_dataset(name: str, path: str):
+    if name.lower().endswith('.csv') and os.path.getsize(path) >= LARGE_DATA_THRESHOLD_BYTES:
+        if duckdb is not None:
+            return convert_large_dataset(name, path)
+        log.warning(f"'{name}' is above the large-data threshold but duckdb is not installed. Sniffing it instead.")
+    return sniff_dataset(name, path)
@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from logger_setup import log
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_MAX_QUEUED = int(os.environ.get("JOB_MAX_QUEUED", "16"))
+JOB_DEFAULT_DEADLINE_SECONDS = float(os.environ.get("JOB_DEFAULT_DEADLINE_SECONDS", "280"))
+JOB_MAX_DEADLINE_SECONDS = float(os.environ.get("JOB_MAX_DEADLINE_SECONDS", "1800"))
+JOB_RETENTION_SECONDS = float(os.environ.get("JOB_RETENTION_SECONDS", "3600"))
+
+
+class JobQueueFullError(RuntimeError):
+    pass
+
+
+class Job:
+    def __init__(self, deadline_seconds: float):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"
+        self.deadline_seconds = deadline_seconds
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.steps = []
+        self.result = None
+        self.http_status = None
+        self.cancelled = False
+        self._started = threading.Event()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.started_at = time.time()
+        self.status = "running"
+        self._started.set()
+
+    def cancel(self):
+        # A cancelled job that is still queued never runs; a running one stops before its next plan step.
+        self.cancelled = True
+
+    def seconds_remaining(self) -> float:
+        if self.cancelled:
+            return 0.0
+        started_at = self.started_at or time.time()
+        return self.deadline_seconds - (time.time() - started_at)
+
+    def start_step(self, index: int, tool: str):
+        with self._lock:
+            self.steps.append({"step": index + 1, "tool": tool, "status": "running",
+                               "started_at": time.time(), "duration": None})
+
+    def finish_step(self, index: int, status: str = "succeeded"):
+        with self._lock:
+            for step in self.steps:
+                if step["step"] == index + 1:
+                    step["status"] = status
+                    step["duration"] = time.time() - step["started_at"]
+
+    def finish(self, result: dict, http_status: int):
+        with self._lock:
+            self.result = result
+            self.http_status = http_status
+            self.status = "succeeded" if http_status < 400 else "failed"
+            self.finished_at = time.time()
+        self._done.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._done.wait(timeout)
+
+    def wait_for_deadline(self, grace_seconds: float = 0.0) -> bool:
+        # The deadline only starts counting once the job leaves the queue, as in seconds_remaining.
+        # Waiting in the queue is bounded by a full deadline as well.
+        if not self._started.wait(self.deadline_seconds + grace_seconds):
+            return self.is_done()
+        elapsed = time.time() - self.started_at
+        return self._done.wait(max(0.0, self.deadline_seconds + grace_seconds - elapsed))
+
+    def is_done(self) -> bool:
+        return self._done.is_set()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            payload = {
+                "job_id": self.id,
+                "status": self.status,
+                "deadline_seconds": self.deadline_seconds,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "steps": [dict(step) for step in self.steps],
+            }
+            if self.is_done():
+                payload["http_status"] = self.http_status
+                payload["result"] = self.result
+            return payload
+
+
+class JobManager:
+    def __init__(self, workers: int = JOB_WORKERS, max_queued: int = JOB_MAX_QUEUED):
+        self.workers = workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis-job")
+        self._jobs = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, deadline_seconds: float = None, *args, **kwargs) -> Job:
+        if deadline_seconds is not None and not deadline_seconds > 0:
+            raise ValueError(f"deadline must be a positive number of seconds, got {deadline_seconds}.")
+        deadline_seconds = min(deadline_seconds or JOB_DEFAULT_DEADLINE_SECONDS, JOB_MAX_DEADLINE_SECONDS)
+        with self._lock:
+            self._purge_finished()
+            # Jobs that are running or waiting for a worker both count against the admission limit.
+            if self._pending >= self.workers + self.max_queued:
+                raise JobQueueFullError(
+                    f"Server is busy: {self._pending} jobs are already running or queued. Try again later.")
+            self._pending += 1
+            job = Job(deadline_seconds)
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, *args, **kwargs)
+        log.info(f"Accepted job {job.id} with a {deadline_seconds}s deadline.")
+        return job
+
+    def _run(self, job: Job, fn, *args, **kwargs):
+        job.start()
+        try:
+            if job.cancelled:
+                log.warning(f"Job {job.id} was cancelled while it was queued. Not running it.")
+                result, http_status = {"error": "Processing timed out."}, 500
+            else:
+                result, http_status = fn(job, *args, **kwargs)
+        except Exception as e:
+            log.error(f"Job {job.id} crashed.", exc_info=True)
+            result, http_status = {"error": f"Internal server error: {e}"}, 500
+        finally:
+            with self._lock:
+                self._pending -= 1
+        job.finish(result, http_status)
+        log.info(f"Job {job.id} finished with status {job.status} in {job.finished_at - job.started_at:.2f}s.")
+
+    def _purge_finished(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished_at and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"workers": self.workers, "max_queued": self.max_queued, "pending": self._pending}
@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.api_core import exceptions as google_exceptions
+from logger_setup import log
+from tracing import span
+
+GEMINI_KEY_COOLDOWN_SECONDS = float(os.environ.get("GEMINI_KEY_COOLDOWN_SECONDS", "60"))
+GEMINI_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("GEMINI_CIRCUIT_FAILURE_THRESHOLD", "3"))
+GEMINI_CIRCUIT_OPEN_SECONDS = float(os.environ.get("GEMINI_CIRCUIT_OPEN_SECONDS", "300"))
+
+QUOTA_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+AUTH_ERRORS = (google_exceptions.Unauthenticated, google_exceptions.PermissionDenied,
+               google_exceptions.Unauthorized, google_exceptions.Forbidden)
+SERVER_ERRORS = (google_exceptions.ServerError, google_exceptions.DeadlineExceeded, google_exceptions.RetryError)
+TRANSPORT_ERRORS = (ConnectionError, TimeoutError, OSError)
+
+
+def is_auth_error(error: Exception) -> bool:
+    # Gemini rejects a malformed key with a 400 InvalidArgument rather than a 401.
+    return isinstance(error, AUTH_ERRORS) or (isinstance(error, google_exceptions.InvalidArgument)
+                                              and "api key" in str(error).lower())
+
+
+def is_key_error(error: Exception) -> bool:
+    # Only failures that another key could avoid count against a key. Errors caused by the request itself
+    # (a bad or oversized prompt, a safety block, a response without text) would fail on every key.
+    return (is_auth_error(error) or isinstance(error, QUOTA_ERRORS + SERVER_ERRORS + TRANSPORT_ERRORS)
+            or "429" in str(error))
+
+
+class KeyState:
+    def __init__(self, index: int, api_key: str):
+        self.index = index
+        self.api_key = api_key
+        self.model = None
+        self.consecutive_failures = 0
+        self.available_at = 0.0
+        self.successes = 0
+        self.failures = 0
+
+    @property
+    def label(self) -> str:
+        return f"#{self.index + 1}"
+
+
+class GeminiModelPool:
+    def __init__(self, api_keys: list, model_name: str):
+        self.model_name = model_name
+        self._keys = [KeyState(i, key.strip()) for i, key in enumerate(api_keys) if key and key.strip()]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _get_model(self, state: KeyState):
+        if state.model is None:
+            # Each key gets its own client instead of going through the process-global genai.configure,
+            # so concurrent requests never race on which key is active. _ClientManager is private, which is
+            # why google-generativeai is pinned in requirements.txt.
+            manager = genai_client._ClientManager()
+            manager.configure(api_key=state.api_key)
+            model = genai.GenerativeModel(self.model_name)
+            model._client = manager.get_default_client("generative")
+            state.model = model
+        return state.model
+
+    def acquire(self) -> KeyState:
+        if not self._keys:
+            raise ValueError("GEMINI_API_KEYS list is empty.")
+        with span("model_acquire") as acquire_span, self._lock:
+            now = time.monotonic()
+            for offset in range(len(self._keys)):
+                state = self._keys[(self._next + offset) % len(self._keys)]
+                if state.available_at <= now:
+                    self._next = (state.index + 1) % len(self._keys)
+                    self._get_model(state)
+                    acquire_span.set(key=state.label)
+                    return state
+            raise ConnectionError("All Gemini API keys are cooling down or have an open circuit.")
+
+    def report_success(self, state: KeyState):
+        with self._lock:
+            if state.consecutive_failures >= GEMINI_CIRCUIT_FAILURE_THRESHOLD:
+                log.info(f"Gemini key {state.label} recovered. Closing its circuit.")
+            state.consecutive_failures = 0
+            state.available_at = 0.0
+            state.successes += 1
+
+    def report_failure(self, state: KeyState, error: Exception):
+        with self._lock:
+            state.consecutive_failures += 1
+            state.failures += 1
+            now = time.monotonic()
+            if is_auth_error(error):
+                state.available_at = now + GEMINI_CIRCUIT_OPEN_SECONDS
+                log.warning(f"Gemini key {state.label} was rejected ({error}). Disabled for {GEMINI_CIRCUIT_OPEN_SECONDS}s.")
+            elif isinstance(error, QUOTA_ERRORS) or "429" in str(error):
+                state.available_at = now + GEMINI_KEY_COOLDOWN_SECONDS
+                log.warning(f"Gemini key {state.label} hit its quota. Cooling down for {GEMINI_KEY_COOLDOWN_SECONDS}s.")
+            elif state.consecutive_failures >= GEMINI_CIRCUIT_FAILURE_THRESHOLD:
+                state.available_at = now + GEMINI_CIRCUIT_OPEN_SECONDS
+                log.warning(f"Gemini key {state.label} failed {state.consecutive_failures} times in a row. "
+                            f"Opening its circuit for {GEMINI_CIRCUIT_OPEN_SECONDS}s.")
+            else:
+                log.warning(f"Gemini key {state.label} failed ({error}).")
+
+    def generate_content(self, *args, **kwargs):
+        last_error = None
+        for _ in range(max(1, len(self._keys))):
+            state = self.acquire()
+            try:
+                log.info(f"Calling {self.model_name} with Gemini key {state.label}...")
+                response = state.model.generate_content(*args, **kwargs)
+                self.report_success(state)
+                return response
+            except Exception as e:
+                if not is_key_error(e):
+                    raise
+                self.report_failure(state, e)
+                last_error = e
+        raise ConnectionError(f"All attempted Gemini API keys failed. Last error: {last_error}")
+
+    def generate_content_stream(self, *args, **kwargs):
+        last_error = None
+        for _ in range(max(1, len(self._keys))):
+            state = self.acquire()
+            yielded = False
+            try:
+                log.info(f"Streaming from {self.model_name} with Gemini key {state.label}...")
+                for chunk in state.model.generate_content(*args, stream=True, **kwargs):
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # Chunks without text parts (e.g. the closing finish_reason chunk) carry nothing to parse.
+                        continue
+                    yielded = True
+                    yield text
+                self.report_success(state)
+                return
+            except Exception as e:
+                if not is_key_error(e):
+                    raise
+                self.report_failure(state, e)
+                # Once text has been handed to the caller the stream cannot be transparently restarted on another key.
+                if yielded:
+                    raise
+                last_error = e
+        raise ConnectionError(f"All attempted Gemini API keys failed. Last error: {last_error}")
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from logger_setup import log
+
+PLAN_CACHE_ENABLED = os.environ.get("PLAN_CACHE_ENABLED", "1") == "1"
+PLAN_CACHE_DIR = os.environ.get("PLAN_CACHE_DIR", "plan_cache")
+PLAN_CACHE_MAX_ENTRIES = int(os.environ.get("PLAN_CACHE_MAX_ENTRIES", "256"))
+PLAN_CACHE_TTL_SECONDS = float(os.environ.get("PLAN_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+PLAN_CACHE_BYPASS_HEADER = "X-Plan-Cache"
+
+
+def make_plan_cache_key(questions: str, schema_info: str, column_dtypes: dict, image_hashes: list,
+                        model_name: str, planner_prompt: str) -> str:
+    normalized_questions = re.sub(r"\s+", " ", questions).strip()
+    payload = json.dumps({
+        # Plans made by another model or from an older prompt may use a different plan format.
+        "model": model_name,
+        "prompt": hashlib.sha256(planner_prompt.encode("utf-8")).hexdigest(),
+        "questions": normalized_questions,
+        "schema": schema_info,
+        "dtypes": column_dtypes,
+        "images": sorted(image_hashes),
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PlanCache:
+    def __init__(self, cache_dir: str = PLAN_CACHE_DIR, max_entries: int = PLAN_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = PLAN_CACHE_TTL_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index = OrderedDict()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _load_index(self):
+        # Entries are ordered by last access (file mtime) so LRU order survives restarts.
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                entries.append((os.path.getmtime(os.path.join(self.cache_dir, name)), name[:-5]))
+        for _, key in sorted(entries):
+            self._index[key] = None
+        self._evict()
+        log.info(f"Plan cache loaded with {len(self._index)} entries from '{self.cache_dir}'.")
+
+    def _remove(self, key: str):
+        self._index.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while len(self._index) > self.max_entries:
+            oldest_key = next(iter(self._index))
+            self._remove(oldest_key)
+
+    def get(self, key: str):
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                log.warning(f"Discarding unreadable plan cache entry {key}.")
+                self._remove(key)
+                self.misses += 1
+                return None
+            if time.time() - entry["created_at"] > self.ttl_seconds:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            os.utime(self._path(key))
+            self.hits += 1
+            return entry["plan"]
+
+    def put(self, key: str, plan: list):
+        with self._lock:
+            path = self._path(key)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created_at": time.time(), "plan": plan}, f)
+            os.replace(tmp_path, path)
+            self._index[key] = None
+            self._index.move_to_end(key)
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": PLAN_CACHE_ENABLED,
+                "entries": len(self._index),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,315 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from logger_setup import log
+from tools import web_scraper, python_interpreter
+from tracing import span, submit_in_context
+from step_cache import get_step_cache, make_step_cache_key, uncacheable_reason
+
+PLAN_MAX_PARALLEL_STEPS = int(os.environ.get("PLAN_MAX_PARALLEL_STEPS", "4"))
+DEFAULT_SLOT = "df"
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=PLAN_MAX_PARALLEL_STEPS, thread_name_prefix="plan-prefetch")
+
+
+class PlanTimeoutError(RuntimeError):
+    pass
+
+
+class PlanNode:
+    def __init__(self, index: int, step: dict):
+        self.index = index
+        self.id = str(step.get("id") or f"step{index + 1}")
+        self.tool = step.get("tool")
+        self.args = step.get("args", {})
+        # Models sometimes write null for "no dependencies" or "default output".
+        self.depends_on = [str(dep) for dep in step.get("depends_on") or []]
+        self.inputs = step.get("inputs")
+        self.output = step.get("output") or DEFAULT_SLOT
+        # Plans mark steps with non-reproducible output (network, unseeded randomness) as "cache": false.
+        self.cache = step.get("cache", True) is not False
+        self.duration = 0.0
+        self.stdout = None
+
+
+def plan_has_dependencies(plan: list) -> bool:
+    # Ids alone only label steps; a plan runs as a graph only once it declares dependencies.
+    return any(isinstance(step, dict) and "depends_on" in step for step in plan)
+
+
+def build_plan_graph(plan: list) -> list:
+    nodes = [PlanNode(i, step) for i, step in enumerate(plan)]
+    by_id = {}
+    for node in nodes:
+        if node.id in by_id:
+            raise ValueError(f"Duplicate plan step id '{node.id}'.")
+        by_id[node.id] = node
+
+    for node in nodes:
+        for dep in node.depends_on:
+            if dep not in by_id:
+                raise ValueError(f"Step '{node.id}' depends on unknown step '{dep}'.")
+        if not node.output.isidentifier():
+            raise ValueError(f"Step '{node.id}' has an invalid output slot name '{node.output}'.")
+
+    # The final step is the join point: it always runs after every other step.
+    final_node = nodes[-1]
+    explicit_final_deps = list(final_node.depends_on)
+    final_node.depends_on = [node.id for node in nodes[:-1]]
+
+    for node in nodes:
+        if node.inputs is None:
+            sources = (explicit_final_deps or final_node.depends_on) if node is final_node else node.depends_on
+            node.inputs = list(dict.fromkeys(by_id[dep].output for dep in sources))
+        node.inputs = [str(slot_name) for slot_name in node.inputs]
+        for slot_name in node.inputs:
+            if not slot_name.isidentifier():
+                raise ValueError(f"Step '{node.id}' has an invalid input slot name '{slot_name}'.")
+
+    # Kahn's algorithm, only to reject cycles before anything starts running.
+    remaining = {node.id: set(node.depends_on) for node in nodes}
+    while remaining:
+        ready = [node_id for node_id, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(f"Plan steps {sorted(remaining)} form a dependency cycle.")
+        for node_id in ready:
+            del remaining[node_id]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+    ancestors = {}
+
+    def ancestors_of(node_id: str) -> set:
+        if node_id not in ancestors:
+            deps = by_id[node_id].depends_on
+            ancestors[node_id] = set(deps).union(*(ancestors_of(dep) for dep in deps))
+        return ancestors[node_id]
+
+    # Steps that can run at the same time must not write the same slot, or the last one to finish would win.
+    for i, node in enumerate(nodes):
+        for other in nodes[i + 1:]:
+            if node.output == other.output and node.id not in ancestors_of(other.id) \
+                    and other.id not in ancestors_of(node.id):
+                raise ValueError(f"Steps '{node.id}' and '{other.id}' both write the '{node.output}' slot "
+                                 f"but do not depend on each other.")
+
+    # A slot written by a step that is not an ancestor may or may not exist yet when this step starts.
+    for node in nodes:
+        available = {by_id[ancestor].output for ancestor in ancestors_of(node.id)}
+        for slot_name in node.inputs:
+            if slot_name not in available:
+                raise ValueError(f"Step '{node.id}' reads the '{slot_name}' slot, but none of the steps it "
+                                 f"depends on writes it.")
+    return nodes
+
+
+def log_plan_timing(nodes: list, wall_clock: float):
+    by_id = {node.id: node for node in nodes}
+    finish_times, predecessors = {}, {}
+
+    def finish_time(node_id: str) -> float:
+        if node_id not in finish_times:
+            node = by_id[node_id]
+            best_dep = max(node.depends_on, key=finish_time, default=None)
+            finish_times[node_id] = node.duration + (finish_times[best_dep] if best_dep else 0.0)
+            predecessors[node_id] = best_dep
+        return finish_times[node_id]
+
+    for node in nodes:
+        finish_time(node.id)
+    if not finish_times:
+        return
+    tail = max(finish_times, key=finish_times.get)
+    path = []
+    while tail is not None:
+        path.append(tail)
+        tail = predecessors[tail]
+    log.info(f"Plan finished in {wall_clock:.2f}s wall-clock; critical path {finish_times[path[0]]:.2f}s "
+             f"({' -> '.join(reversed(path))}) over {len(nodes)} step(s).")
+
+
+WEB_SCRAPER_ARGS = ("url", "table", "caption", "columns")
+
+
+def scraper_kwargs(args: dict) -> dict:
+    return {name: args.get(name) for name in WEB_SCRAPER_ARGS if args.get(name) is not None}
+
+
+def prefetch_step(step: dict, prefetched: dict):
+    # Only side-effect-free fetches are started early; if the final plan never uses them they are simply dropped.
+    if not isinstance(step, dict) or step.get("tool") != "web_scraper":
+        return
+    kwargs = scraper_kwargs(step.get("args", {}))
+    key = json.dumps(kwargs, sort_keys=True)
+    if kwargs.get("url") and key not in prefetched:
+        log.info(f"Prefetching '{kwargs['url']}' while the plan is still being generated.")
+        prefetched[key] = submit_in_context(_prefetch_executor, web_scraper, **kwargs)
+
+
+def scrape(args: dict, prefetched: dict = None):
+    kwargs = scraper_kwargs(args)
+    future = prefetched.pop(json.dumps(kwargs, sort_keys=True), None) if prefetched else None
+    if future is not None:
+        log.info(f"Using prefetched result for '{kwargs.get('url')}'.")
+        with span("prefetch_wait", tool="web_scraper"):
+            return future.result()
+    return web_scraper(**kwargs)
+
+
+def run_python_step(node: PlanNode, cache_steps: bool, **kwargs):
+    step_cache = get_step_cache()
+    key = None
+    if cache_steps and step_cache.enabled:
+        reason = "the plan marked it as not cacheable" if not node.cache else uncacheable_reason(kwargs["code"] or "")
+        if reason:
+            log.info(f"Not caching step '{node.id}': {reason}.")
+        else:
+            with span("step_cache_lookup", tool="python_interpreter") as lookup_span:
+                key = make_step_cache_key(kwargs["code"], data=kwargs.get("data"), files=kwargs.get("files"),
+                                          datasets=kwargs.get("datasets"), tables=kwargs.get("tables"),
+                                          output_name=kwargs.get("output_name", DEFAULT_SLOT))
+                cached = step_cache.get(key) if key else None
+                lookup_span.set(hit=cached is not None)
+            if cached is not None:
+                log.info(f"Step cache hit for step '{node.id}' ({key[:12]}). Skipping the sandbox.")
+                return cached
+
+    stdout, modified_df = python_interpreter(**kwargs)
+    if key:
+        step_cache.put(key, stdout, modified_df)
+    return stdout, modified_df
+
+
+def run_plan(plan: list, job, files: dict = None, prefetched: dict = None, tables: dict = None,
+             cache_steps: bool = True):
+    if plan_has_dependencies(plan):
+        return run_dependency_graph(plan, job, files, prefetched, tables, cache_steps)
+    return run_sequential(plan, job, files, prefetched, tables, cache_steps)
+
+
+def run_sequential(plan: list, job, files: dict = None, prefetched: dict = None, tables: dict = None,
+                   cache_steps: bool = True):
+    plan_start = time.perf_counter()
+    context_data = None
+    nodes = []
+    final_step_index = len(plan) - 1
+    final_stdout = None
+    for i, step in enumerate(plan):
+        node = PlanNode(i, step)
+        if nodes:
+            node.depends_on = [nodes[-1].id]
+        nodes.append(node)
+        is_final_step = (i == final_step_index)
+        log.info(f"Executing {'FINAL' if is_final_step else 'INTERMEDIATE'} step {i + 1}: tool='{node.tool}'")
+
+        if job.seconds_remaining() <= 0:
+            log.error("Execution timed out before completing all steps.")
+            raise PlanTimeoutError("Processing timed out.")
+        job.start_step(i, node.tool)
+        step_start = time.perf_counter()
+
+        try:
+            with span("step", tool=node.tool, step=node.id):
+                if node.tool == "web_scraper":
+                    context_data = scrape(node.args, prefetched)
+                elif node.tool == "python_interpreter":
+                    stdout, modified_df = run_python_step(
+                        node, cache_steps,
+                        code=node.args.get("code"),
+                        data=context_data,
+                        files=files,
+                        timeout=job.seconds_remaining(),
+                        tables=tables
+                    )
+                    context_data = modified_df
+                    if is_final_step:
+                        final_stdout = stdout
+                else:
+                    log.warning(f"Unknown tool '{node.tool}' requested in plan.")
+                    if is_final_step:
+                        raise ValueError(f"Final step requested an unknown tool: {node.tool}")
+        except Exception:
+            log.error(f"Error during plan execution at step {i + 1}.", exc_info=True)
+            job.finish_step(i, "failed")
+            raise
+
+        node.duration = time.perf_counter() - step_start
+        job.finish_step(i)
+
+    log_plan_timing(nodes, time.perf_counter() - plan_start)
+    return final_stdout
+
+
+def run_dependency_graph(plan: list, job, files: dict = None, prefetched: dict = None, tables: dict = None,
+                         cache_steps: bool = True):
+    nodes = build_plan_graph(plan)
+    final_node = nodes[-1]
+    slots = {}
+    slots_lock = threading.Lock()
+    log.info(f"Executing a dependency-aware plan with {len(nodes)} steps "
+             f"(up to {PLAN_MAX_PARALLEL_STEPS} in parallel).")
+
+    def run_node(node: PlanNode):
+        job.start_step(node.index, node.tool)
+        step_start = time.perf_counter()
+        log.info(f"Executing step '{node.id}': tool='{node.tool}', inputs={node.inputs}, output='{node.output}'")
+        try:
+            with span("step", tool=node.tool, step=node.id):
+                if node.tool == "web_scraper":
+                    result = scrape(node.args, prefetched)
+                    with slots_lock:
+                        slots[node.output] = result
+                elif node.tool == "python_interpreter":
+                    with slots_lock:
+                        datasets = {name: slots[name] for name in node.inputs if name in slots}
+                    stdout, modified_df = run_python_step(
+                        node, cache_steps,
+                        code=node.args.get("code"),
+                        files=files,
+                        timeout=job.seconds_remaining(),
+                        datasets=datasets,
+                        output_name=node.output,
+                        tables=tables
+                    )
+                    node.stdout = stdout
+                    if modified_df is not None:
+                        with slots_lock:
+                            slots[node.output] = modified_df
+                else:
+                    log.warning(f"Unknown tool '{node.tool}' requested in plan.")
+                    if node is final_node:
+                        raise ValueError(f"Final step requested an unknown tool: {node.tool}")
+        except Exception:
+            log.error(f"Error during plan execution at step '{node.id}'.", exc_info=True)
+            job.finish_step(node.index, "failed")
+            raise
+        node.duration = time.perf_counter() - step_start
+        job.finish_step(node.index)
+
+    plan_start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=PLAN_MAX_PARALLEL_STEPS, thread_name_prefix="plan-step")
+    try:
+        pending = {node.id: node for node in nodes}
+        running = {}
+        completed = set()
+        while pending or running:
+            ready = [node for node in pending.values() if set(node.depends_on) <= completed]
+            for node in ready:
+                if job.seconds_remaining() <= 0:
+                    log.error("Execution timed out before completing all steps.")
+                    raise PlanTimeoutError("Processing timed out.")
+                del pending[node.id]
+                running[submit_in_context(executor, run_node, node)] = node
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                future.result()
+                completed.add(node.id)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    log_plan_timing(nodes, time.perf_counter() - plan_start)
+    return final_node.stdout if final_node.tool == "python_interpreter" else None
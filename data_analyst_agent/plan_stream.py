@@ -0,0 +1,100 @@
+import json
+import os
+import re
+from logger_setup import log
+from model_pool import is_key_error
+
+PLAN_STREAMING_ENABLED = os.environ.get("PLAN_STREAMING_ENABLED", "1") == "1"
+
+
+def parse_plan_text(text: str) -> list:
+    json_match = re.search(r'\[.*\]', text, re.DOTALL)
+    if not json_match:
+        raise json.JSONDecodeError("No JSON array found in LLM response.", text, 0)
+    return json.loads(json_match.group(0))
+
+
+# Scans a streamed JSON array incrementally and emits each top-level step object as soon as it closes.
+class StreamingPlanParser:
+    def __init__(self):
+        self.steps = []
+        self.complete = False
+        self.failed = False
+        self._text = ""
+        self._pos = 0
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._object_start = None
+
+    def feed(self, chunk: str) -> list:
+        self._text += chunk
+        new_steps = []
+        while self._pos < len(self._text) and not (self.complete or self.failed):
+            ch = self._text[self._pos]
+            if not self._started:
+                if ch == '[':
+                    self._started = True
+                    self._depth = 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif self._depth == 1:
+                if ch == '{':
+                    self._object_start = self._pos
+                    self._depth = 2
+                elif ch == ']':
+                    self._depth = 0
+                    self.complete = True
+                elif ch not in ', \t\r\n':
+                    # Only arrays of step objects can be dispatched incrementally.
+                    self.failed = True
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 1:
+                    try:
+                        step = json.loads(self._text[self._object_start:self._pos + 1])
+                    except ValueError:
+                        self.failed = True
+                    else:
+                        self.steps.append(step)
+                        new_steps.append(step)
+            self._pos += 1
+        return new_steps
+
+
+def stream_plan(model_pool, contents, generation_config, on_step=None) -> tuple[str, list]:
+    parser = StreamingPlanParser()
+    chunks = []
+    try:
+        for text in model_pool.generate_content_stream(contents, generation_config=generation_config):
+            chunks.append(text)
+            for step in parser.feed(text):
+                log.info(f"Streamed plan step {len(parser.steps)}: tool='{step.get('tool')}'")
+                if on_step is not None:
+                    on_step(step)
+    except Exception as e:
+        # Errors caused by the request itself would fail again. Anything else (a transport or server error, or
+        # every key failing) is retried without streaming, even mid-stream: steps already handed to on_step only
+        # started side-effect-free prefetches, so there is nothing to undo.
+        if not is_key_error(e):
+            raise
+        when = f"after {len(parser.steps)} step(s)" if chunks else "before any output arrived"
+        log.warning(f"Streaming the plan failed {when}. Retrying without streaming.", exc_info=True)
+        response = model_pool.generate_content(contents, generation_config=generation_config)
+        return response.text, parse_plan_text(response.text)
+
+    raw_text = "".join(chunks)
+    if parser.complete and not parser.failed:
+        return raw_text, parser.steps
+    log.warning("Could not parse the streamed plan incrementally. Falling back to parsing the full response.")
+    return raw_text, parse_plan_text(raw_text)
@@ -0,0 +1,373 @@
+import atexit
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from logger_setup import log
+from tracing import span
+from sandbox_worker import REQUEST_FILE, RESPONSE_FILE, READY_FILE
+
+try:
+    import docker
+except ImportError:
+    docker = None
+
+SANDBOX_IMAGE = "python:3.10-slim-data-analyst"
+# "docker", or "subprocess" for local development only: it runs generated code on the host without isolation.
+SANDBOX_BACKEND = os.environ.get("SANDBOX_BACKEND", "docker")
+SANDBOX_POOL_SIZE = int(os.environ.get("SANDBOX_POOL_SIZE", "2"))
+SANDBOX_MAX_RUNS_PER_WORKER = int(os.environ.get("SANDBOX_MAX_RUNS_PER_WORKER", "25"))
+SANDBOX_EXEC_TIMEOUT = float(os.environ.get("SANDBOX_EXEC_TIMEOUT", "120"))
+SANDBOX_STARTUP_TIMEOUT = float(os.environ.get("SANDBOX_STARTUP_TIMEOUT", "90"))
+SANDBOX_ACQUIRE_TIMEOUT = float(os.environ.get("SANDBOX_ACQUIRE_TIMEOUT", "120"))
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py")
+CONTAINER_WORKER_SCRIPT = "/opt/sandbox/sandbox_worker.py"
+CONTAINER_HEARTBEAT_FILE = "/opt/sandbox/heartbeat"
+HEARTBEAT_INTERVAL = 5.0
+# The worker enforces the timeout itself; this is how much longer the pool waits before giving up on it.
+EXEC_TIMEOUT_GRACE = 10.0
+POLL_INTERVAL = 0.01
+
+
+class SandboxTimeoutError(RuntimeError):
+    pass
+
+
+class SandboxWorker:
+    def __init__(self, root_dir: str, worker_id: int):
+        self.root_dir = root_dir
+        self.worker_id = worker_id
+        self.workdir = os.path.join(root_dir, f"worker_{worker_id}")
+        os.makedirs(self.workdir)
+        self.runs = 0
+        self.broken = False
+        self.last_result = {}
+        self.runtime = None
+
+    def start(self):
+        raise NotImplementedError
+
+    def is_alive(self) -> bool:
+        raise NotImplementedError
+
+    def kill(self):
+        raise NotImplementedError
+
+    def wait_ready(self, timeout: float):
+        ready_path = os.path.join(self.workdir, READY_FILE)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if os.path.exists(ready_path):
+                with open(ready_path, "r", encoding="utf-8") as f:
+                    info = json.load(f)
+                self.runtime = info.get("runtime")
+                log.info(f"Sandbox worker #{self.worker_id} ready with preloaded modules: {info.get('modules')}")
+                return
+            if not self.is_alive():
+                raise RuntimeError(f"Sandbox worker #{self.worker_id} exited during startup.")
+            time.sleep(0.05)
+        raise SandboxTimeoutError(f"Sandbox worker #{self.worker_id} did not become ready in {timeout}s.")
+
+    def runtime_id(self) -> str:
+        return f"{sys.executable}:{self.runtime}"
+
+    def execute(self, script_name: str, timeout: float = None) -> str:
+        timeout = min(timeout, SANDBOX_EXEC_TIMEOUT) if timeout is not None else SANDBOX_EXEC_TIMEOUT
+        timeout = max(timeout, 1.0)
+        job_id = uuid.uuid4().hex
+        request_path = os.path.join(self.workdir, REQUEST_FILE)
+        response_path = os.path.join(self.workdir, RESPONSE_FILE)
+
+        tmp_path = request_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"job_id": job_id, "script": script_name, "timeout": timeout}, f)
+        os.replace(tmp_path, request_path)
+        self.runs += 1
+
+        deadline = time.monotonic() + timeout + EXEC_TIMEOUT_GRACE
+        polls = 0
+        while not os.path.exists(response_path):
+            if time.monotonic() > deadline:
+                self.broken = True
+                raise SandboxTimeoutError(f"Code execution timed out after {timeout}s.")
+            polls += 1
+            if polls % 100 == 0 and not self.is_alive():
+                self.broken = True
+                raise RuntimeError("Code execution failed: sandbox worker crashed.")
+            time.sleep(POLL_INTERVAL)
+
+        with open(response_path, "r", encoding="utf-8") as f:
+            result = json.load(f)
+        os.remove(response_path)
+        self.last_result = result
+        if result.get("leaked"):
+            log.warning(f"A script left processes or threads behind in sandbox worker #{self.worker_id}. "
+                        f"Recycling it.")
+            self.broken = True
+
+        stdout = result["stdout"].strip()
+        stderr = result["stderr"].strip()
+        if result.get("timed_out"):
+            raise SandboxTimeoutError(f"Code execution timed out after {timeout}s.")
+        if result["status"] != "ok":
+            log.error(f"Error executing code in sandbox worker #{self.worker_id}. STDERR:\n{stderr}")
+            raise RuntimeError(f"Code execution failed: {stderr}")
+        if stderr:
+            log.debug(f"Sandbox worker #{self.worker_id} stderr:\n{stderr}")
+        log.info(f"Sandbox worker #{self.worker_id} finished in {result['duration']:.2f}s.")
+        return stdout
+
+    def reset(self):
+        for entry in os.listdir(self.workdir):
+            path = os.path.join(self.workdir, entry)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stop(self):
+        try:
+            self.kill()
+        except Exception:
+            log.warning(f"Failed to stop sandbox worker #{self.worker_id}.", exc_info=True)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class SubprocessSandboxWorker(SandboxWorker):
+    def start(self):
+        # Only what Python needs to start, so generated code never sees the server's keys or credentials.
+        env = {"PATH": os.environ.get("PATH", os.defpath), "MPLBACKEND": "Agg",
+               "MPLCONFIGDIR": os.path.join(os.path.dirname(self.workdir), "mplconfig")}
+        if "SYSTEMROOT" in os.environ:
+            env["SYSTEMROOT"] = os.environ["SYSTEMROOT"]
+        self._process = subprocess.Popen(
+            [sys.executable, WORKER_SCRIPT, self.workdir, "--parent-pid", str(os.getpid())],
+            cwd=self.workdir, env=env,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+    def is_alive(self) -> bool:
+        return self._process.poll() is None
+
+    def kill(self):
+        if self.is_alive():
+            # SIGTERM first, so the worker can take down the process group of the script it is running.
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait(timeout=10)
+
+
+class DockerSandboxWorker(SandboxWorker):
+    def start(self):
+        client = docker.from_env()
+        self._container = client.containers.run(
+            SANDBOX_IMAGE,
+            command=["python", "-u", CONTAINER_WORKER_SCRIPT, "/app", "--heartbeat-file", CONTAINER_HEARTBEAT_FILE],
+            volumes={
+                self.workdir: {'bind': '/app', 'mode': 'rw'},
+                WORKER_SCRIPT: {'bind': CONTAINER_WORKER_SCRIPT, 'mode': 'ro'},
+                # The server's PID is not visible in the container, so the worker watches this file instead and
+                # exits once the server stops touching it, even after an unclean exit.
+                heartbeat_path(self.root_dir): {'bind': CONTAINER_HEARTBEAT_FILE, 'mode': 'ro'},
+            },
+            working_dir="/app",
+            environment={"MPLBACKEND": "Agg", "HOME": "/tmp", "MPLCONFIGDIR": "/tmp/matplotlib"},
+            # Running as the host user keeps the read-only bit on linked uploads meaningful inside the container.
+            user=f"{os.getuid()}:{os.getgid()}" if hasattr(os, "getuid") else None,
+            detach=True, auto_remove=True
+        )
+
+    def runtime_id(self) -> str:
+        # The image id changes on every rebuild, even when the tag stays the same.
+        return f"{self._container.image.id}:{self.runtime}"
+
+    def is_alive(self) -> bool:
+        try:
+            self._container.reload()
+            return self._container.status in ("created", "running")
+        except Exception:
+            return False
+
+    def kill(self):
+        try:
+            self._container.kill()
+        except docker.errors.APIError:
+            pass
+
+
+def heartbeat_path(root_dir: str) -> str:
+    return os.path.join(root_dir, "heartbeat")
+
+
+class SandboxPool:
+    def __init__(self, size: int = SANDBOX_POOL_SIZE, backend: str = SANDBOX_BACKEND,
+                 max_runs_per_worker: int = SANDBOX_MAX_RUNS_PER_WORKER):
+        self.size = max(1, size)
+        self.max_runs_per_worker = max_runs_per_worker
+        self.backend = self._resolve_backend(backend)
+        self._worker_class = DockerSandboxWorker if self.backend == "docker" else SubprocessSandboxWorker
+        self._root_dir = tempfile.mkdtemp(prefix="sandbox_pool_")
+        self._idle = queue.Queue()
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._next_worker_id = 0
+        self._live_workers = 0
+        self._started = False
+        self._closed = False
+        # Set once a worker is ready; the step cache keys results on it.
+        self.runtime_id = None
+
+    @staticmethod
+    def _resolve_backend(backend: str) -> str:
+        if backend == "docker":
+            if docker is None:
+                raise RuntimeError("SANDBOX_BACKEND is 'docker' but the docker package is not installed.")
+            return backend
+        if backend == "subprocess":
+            log.warning("SANDBOX_BACKEND is 'subprocess': generated code runs on this host WITHOUT a sandbox. "
+                        "Use this for local development only.")
+            return backend
+        raise ValueError(f"Unknown SANDBOX_BACKEND '{backend}'. Use 'docker' or 'subprocess'.")
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self._start_heartbeat()
+        log.info(f"Starting sandbox pool with {self.size} '{self.backend}' worker(s)...")
+        workers = [self._spawn_worker() for _ in range(self.size)]
+        for worker in workers:
+            if worker is not None:
+                self._finish_startup(worker)
+        with self._lock:
+            if self._live_workers == 0:
+                self._started = False
+                raise RuntimeError(f"No '{self.backend}' sandbox worker could be started. Is Docker running? "
+                                   f"Set SANDBOX_BACKEND=subprocess only for local development.")
+
+    def _start_heartbeat(self):
+        path = heartbeat_path(self._root_dir)
+        open(path, "a").close()
+
+        def beat():
+            while not self._closed:
+                try:
+                    # Touched in place: replacing the file would leave containers watching the old one.
+                    os.utime(path)
+                except OSError:
+                    pass
+                time.sleep(HEARTBEAT_INTERVAL)
+
+        threading.Thread(target=beat, name="sandbox-heartbeat", daemon=True).start()
+
+    def _spawn_worker(self):
+        with self._lock:
+            if self._closed or self._live_workers >= self.size:
+                return None
+            self._next_worker_id += 1
+            self._live_workers += 1
+            worker_id = self._next_worker_id
+        try:
+            worker = self._worker_class(self._root_dir, worker_id)
+            with self._lock:
+                self._workers.add(worker)
+            worker.start()
+            return worker
+        except Exception:
+            log.error(f"Failed to start sandbox worker #{worker_id}.", exc_info=True)
+            with self._lock:
+                self._live_workers -= 1
+                self._workers = {w for w in self._workers if w.worker_id != worker_id}
+            return None
+
+    def _finish_startup(self, worker: SandboxWorker):
+        try:
+            worker.wait_ready(SANDBOX_STARTUP_TIMEOUT)
+            self.runtime_id = worker.runtime_id()
+            self._idle.put(worker)
+        except Exception:
+            log.error(f"Sandbox worker #{worker.worker_id} failed to warm up.", exc_info=True)
+            self._retire(worker)
+
+    def _replace_in_background(self):
+        def replace():
+            worker = self._spawn_worker()
+            if worker is not None:
+                self._finish_startup(worker)
+
+        threading.Thread(target=replace, daemon=True).start()
+
+    def _retire(self, worker: SandboxWorker):
+        with self._lock:
+            if worker not in self._workers:
+                return
+            self._workers.discard(worker)
+            self._live_workers -= 1
+        worker.stop()
+
+    @contextmanager
+    def acquire(self, timeout: float = SANDBOX_ACQUIRE_TIMEOUT):
+        if not self._started:
+            self.start()
+        with self._lock:
+            needs_worker = self._live_workers < self.size
+        if needs_worker:
+            self._replace_in_background()
+
+        with span("sandbox_acquire", tool="python_interpreter") as acquire_span:
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise RuntimeError(f"No sandbox worker became available within {timeout}s.")
+            acquire_span.set(worker=worker.worker_id, idle_workers=self._idle.qsize())
+
+        try:
+            yield worker
+        finally:
+            self._release(worker)
+
+    def _release(self, worker: SandboxWorker):
+        if worker.broken or worker.runs >= self.max_runs_per_worker or not worker.is_alive():
+            log.info(f"Recycling sandbox worker #{worker.worker_id} after {worker.runs} run(s).")
+            self._retire(worker)
+            self._replace_in_background()
+            return
+        worker.reset()
+        self._idle.put(worker)
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+        # Busy workers are stopped too; their running step fails as if the worker had crashed.
+        for worker in workers:
+            self._retire(worker)
+        shutil.rmtree(self._root_dir, ignore_errors=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_sandbox_pool() -> SandboxPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool()
+            atexit.register(_pool.shutdown)
+        return _pool
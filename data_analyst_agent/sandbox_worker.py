@@ -0,0 +1,351 @@
+import argparse
+import contextlib
+import ctypes
+import gc
+import hashlib
+import io
+import json
+import os
+import random
+import runpy
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import warnings
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# This script is the long-lived process behind each sandbox pool worker.
+# It is started either inside the sandbox Docker container or as a local
+# subprocess, imports the heavy data-science stack once, and then executes
+# one script at a time from its working directory using a small file-based
+# protocol shared with sandbox_pool.py. Each script runs in a child forked
+# from this warm process, so it starts with every library already imported
+# but nothing it starts or changes outlives it.
+
+REQUEST_FILE = ".request.json"
+RESPONSE_FILE = ".response.json"
+READY_FILE = ".ready"
+POLL_INTERVAL = 0.01
+PR_SET_CHILD_SUBREAPER = 36
+# Without a heartbeat for this long the server is assumed gone and the worker exits.
+HEARTBEAT_TIMEOUT = 60.0
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+PRELOADED_MODULES = [
+    "pandas", "numpy", "matplotlib", "matplotlib.pyplot", "seaborn", "scipy", "scipy.stats",
+    "sklearn", "statsmodels.api", "duckdb", "networkx", "pyarrow",
+]
+
+
+def preload_modules():
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    loaded = []
+    for module_name in PRELOADED_MODULES:
+        try:
+            __import__(module_name)
+            loaded.append(module_name)
+        except Exception:
+            pass
+    return loaded
+
+
+def runtime_fingerprint(loaded: list) -> str:
+    # Identifies the interpreter and library versions scripts run against, for the step cache key.
+    versions = {name: str(getattr(sys.modules.get(name), "__version__", None)) for name in loaded}
+    payload = json.dumps({"python": sys.version, "modules": versions}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def capture_baseline_state() -> dict:
+    baseline = {"environ": dict(os.environ), "sys_path": list(sys.path), "warnings": list(warnings.filters),
+                "threads": threading.active_count()}
+    np = sys.modules.get("numpy")
+    if np is not None:
+        baseline["numpy_err"] = np.geterr()
+        baseline["numpy_print"] = np.get_printoptions()
+    return baseline
+
+
+def reset_interpreter_state(baseline: dict):
+    # Only used where os.fork is unavailable and scripts share one interpreter: any global library state they
+    # change must not reach the next script.
+    plt = sys.modules.get("matplotlib.pyplot")
+    if plt is not None:
+        plt.close("all")
+    matplotlib = sys.modules.get("matplotlib")
+    if matplotlib is not None:
+        matplotlib.rcdefaults()
+    pd = sys.modules.get("pandas")
+    if pd is not None:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            pd.reset_option("all")
+    np = sys.modules.get("numpy")
+    if np is not None:
+        np.seterr(**baseline["numpy_err"])
+        np.set_printoptions(**baseline["numpy_print"])
+        np.random.seed()
+    random.seed()
+    os.environ.clear()
+    os.environ.update(baseline["environ"])
+    sys.path[:] = baseline["sys_path"]
+    warnings.filters[:] = baseline["warnings"]
+    gc.collect()
+
+
+def current_rss_bytes():
+    # Resident set size right now, unlike ru_maxrss which is the process's lifetime high-water mark.
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def child_pids() -> list:
+    # Live processes whose parent is this worker; zombies are left to reap_children. Needs /proc, so it finds
+    # nothing elsewhere.
+    pids = []
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return pids
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # The command name can contain spaces, so the fields are read after its closing parenthesis.
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if fields[0] != "Z" and int(fields[1]) == os.getpid():
+            pids.append(int(entry))
+    return pids
+
+
+def become_subreaper():
+    # Linux only. Processes a script detaches (e.g. with setsid) are re-parented to this worker instead of init
+    # once the script's process exits, so they can still be found and killed.
+    try:
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+
+def kill_leftover_children() -> bool:
+    # Anything still parented to the worker after a script has finished was started by that script.
+    reap_children()
+    leftovers = child_pids()
+    for pid in leftovers:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    reap_children()
+    return bool(leftovers)
+
+
+def reap_children():
+    # A worker running as PID 1 in its container inherits orphaned processes and has to collect them.
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+def kill_process_group(pgid: int):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_script(workdir: str, script_name: str) -> dict:
+    stdout_buffer, stderr_buffer = io.StringIO(), io.StringIO()
+    status = "ok"
+    rss_at_start = current_rss_bytes()
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(stdout_buffer), contextlib.redirect_stderr(stderr_buffer):
+            runpy.run_path(os.path.join(workdir, script_name), run_name="__main__")
+    except BaseException:
+        status = "error"
+        stderr_buffer.write(traceback.format_exc())
+    rss_at_end = current_rss_bytes()
+    return {
+        "status": status,
+        "stdout": stdout_buffer.getvalue(),
+        "stderr": stderr_buffer.getvalue(),
+        # Memory the script still held when it finished.
+        "rss_delta_bytes": rss_at_end - rss_at_start if rss_at_end is not None and rss_at_start is not None else None,
+    }
+
+
+def run_child(workdir: str, script_name: str, result_file):
+    # Never returns: the child must not fall back into the parent's request loop.
+    exit_code = 1
+    try:
+        os.setpgid(0, 0)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        result = run_script(workdir, script_name)
+        result_file.write(json.dumps(result, default=str).encode("utf-8"))
+        result_file.flush()
+        exit_code = 0
+    finally:
+        os._exit(exit_code)
+
+
+class Watchdog:
+    # Tells the worker when the server that started it is gone: its parent PID changed (subprocess backend) or
+    # its heartbeat file went stale (Docker backend, where the server's PID is not visible).
+    def __init__(self, parent_pid: int = None, heartbeat_file: str = None):
+        self.parent_pid = parent_pid
+        self.heartbeat_file = heartbeat_file
+
+    def server_gone(self) -> bool:
+        if self.parent_pid is not None and os.getppid() != self.parent_pid:
+            return True
+        if self.heartbeat_file is not None:
+            try:
+                return time.time() - os.path.getmtime(self.heartbeat_file) > HEARTBEAT_TIMEOUT
+            except OSError:
+                return True
+        return False
+
+
+_current_child = None
+
+
+def execute_script(workdir: str, script_name: str, baseline: dict, timeout: float, watchdog: Watchdog) -> dict:
+    global _current_child
+    if not hasattr(os, "fork"):
+        return execute_in_process(workdir, script_name, baseline)
+
+    start = time.perf_counter()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    timed_out = False
+    with tempfile.TemporaryFile() as result_file:
+        pid = os.fork()
+        if pid == 0:
+            run_child(workdir, script_name, result_file)
+        _current_child = pid
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+
+        deadline = time.monotonic() + timeout
+        polls = 0
+        # WNOWAIT leaves the exited child as a zombie, which keeps its process group id from being reused
+        # until anything the script started has been killed.
+        while os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None:
+            polls += 1
+            if time.monotonic() > deadline or (polls % 100 == 0 and watchdog.server_gone()):
+                timed_out = True
+                break
+            time.sleep(POLL_INTERVAL)
+        kill_process_group(pid)
+        _, _, usage = os.wait4(pid, 0)
+        _current_child = None
+
+        result_file.seek(0)
+        payload = result_file.read()
+
+    if timed_out:
+        result = {"status": "error", "stdout": "", "stderr": f"Code execution timed out after {timeout}s.",
+                  "rss_delta_bytes": None, "timed_out": True}
+    elif payload:
+        result = json.loads(payload.decode("utf-8"))
+    else:
+        result = {"status": "error", "stdout": "", "stderr": "The script's process exited without a result.",
+                  "rss_delta_bytes": None}
+    result["duration"] = time.perf_counter() - start
+    # Peak memory of the forked process that ran this script, including the libraries it inherited.
+    result["max_rss_bytes"] = usage.ru_maxrss * 1024
+    # A process that left the script's process group survived the kill above. It is killed now, but whatever it
+    # started in the meantime may not have been, so the worker is recycled.
+    result["leaked"] = kill_leftover_children()
+    return result
+
+
+def execute_in_process(workdir: str, script_name: str, baseline: dict) -> dict:
+    start = time.perf_counter()
+    try:
+        result = run_script(workdir, script_name)
+    finally:
+        os.chdir(workdir)
+        reset_interpreter_state(baseline)
+    result["duration"] = time.perf_counter() - start
+    # The worker is long-lived, so this is its high-water mark so far, not just this script's.
+    result["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None
+    # Threads or processes a script started cannot be undone here, so the worker has to be recycled.
+    result["leaked"] = threading.active_count() > baseline["threads"] or kill_leftover_children()
+    return result
+
+
+def stop_current_child(signum, frame):
+    if _current_child is not None:
+        kill_process_group(_current_child)
+    sys.exit(0)
+
+
+def write_json_atomically(path: str, payload: dict):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("workdir")
+    parser.add_argument("--parent-pid", type=int)
+    parser.add_argument("--heartbeat-file")
+    args = parser.parse_args()
+    workdir = os.path.abspath(args.workdir)
+    watchdog = Watchdog(args.parent_pid, args.heartbeat_file)
+    signal.signal(signal.SIGTERM, stop_current_child)
+    become_subreaper()
+
+    loaded = preload_modules()
+    baseline = capture_baseline_state()
+    write_json_atomically(os.path.join(workdir, READY_FILE), {"pid": os.getpid(), "modules": loaded,
+                                                              "runtime": runtime_fingerprint(loaded)})
+
+    request_path = os.path.join(workdir, REQUEST_FILE)
+    response_path = os.path.join(workdir, RESPONSE_FILE)
+    polls = 0
+    while True:
+        polls += 1
+        if polls % 100 == 0 and watchdog.server_gone():
+            break
+        if not os.path.exists(request_path):
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        with open(request_path, "r", encoding="utf-8") as f:
+            job = json.load(f)
+        os.remove(request_path)
+
+        if job.get("action") == "shutdown":
+            break
+
+        result = execute_script(workdir, job["script"], baseline, job.get("timeout", 120.0), watchdog)
+        result["job_id"] = job.get("job_id")
+        write_json_atomically(response_path, result)
+
+
+if __name__ == "__main__":
+    main()
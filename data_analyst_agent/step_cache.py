@@ -0,0 +1,307 @@
+import ast
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import pandas as pd
+from logger_setup import log
+from sandbox_pool import get_sandbox_pool
+from tools import write_state_file, read_state_file, STATE_TRANSFER_FORMAT
+
+STEP_CACHE_ENABLED = os.environ.get("STEP_CACHE_ENABLED", "1") == "1"
+STEP_CACHE_DIR = os.environ.get("STEP_CACHE_DIR", "step_cache")
+STEP_CACHE_MAX_BYTES = int(os.environ.get("STEP_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+STEP_CACHE_BYPASS_HEADER = "X-Step-Cache"
+STEP_CACHE_VERSION = "2"
+STDOUT_FILE = "stdout.txt"
+META_FILE = "meta.json"
+
+# Steps whose output can change between identical runs are never cached.
+NETWORK_PATTERN = re.compile(r"https?://|s3://|\bhttpfs\b|\brequests\.|\burllib\b|\bsocket\b|read_html|\bwget\b")
+# SQL run through duckdb is only visible as string literals.
+SQL_CLOCK_PATTERN = re.compile(r"\bcurrent_(?:date|time|timestamp)\b|\b(?:now|today|get_current_time)\s*\(", re.I)
+SQL_RANDOM_PATTERN = re.compile(r"\b(?:random|uuid|gen_random_uuid)\s*\(|\b(?:using\s+sample|tablesample)\b", re.I)
+CLOCK_FUNCTIONS = {"now", "utcnow", "today"}
+CLOCK_TIME_FUNCTIONS = {"time", "time_ns", "localtime", "gmtime", "ctime", "asctime", "strftime", "perf_counter",
+                        "monotonic"}
+CLOCK_STRINGS = {"now", "today"}
+# Calls that draw from numpy's global RNG unless they are given their own seed.
+RANDOM_STATE_CALLS = {
+    "sample", "train_test_split", "KMeans", "MiniBatchKMeans", "RandomForestClassifier", "RandomForestRegressor",
+    "ExtraTreesClassifier", "ExtraTreesRegressor", "GradientBoostingClassifier", "GradientBoostingRegressor",
+    "HistGradientBoostingClassifier", "HistGradientBoostingRegressor", "DecisionTreeClassifier",
+    "DecisionTreeRegressor", "IsolationForest", "TSNE", "GaussianMixture", "PCA", "TruncatedSVD", "NMF",
+    "MLPClassifier", "MLPRegressor", "SGDClassifier", "SGDRegressor", "ShuffleSplit", "StratifiedShuffleSplit",
+    "make_classification", "make_regression", "make_blobs", "resample", "shuffle", "permutation_importance",
+}
+# These only draw random numbers when asked to shuffle.
+SHUFFLE_CALLS = {"KFold", "StratifiedKFold", "RepeatedKFold"}
+SEED_KEYWORDS = {"random_state", "seed", "random_seed"}
+ALWAYS_RANDOM_CALLS = {"uuid1", "uuid4", "urandom", "token_hex", "token_bytes", "token_urlsafe", "randbelow"}
+
+
+def call_name(node: ast.Call) -> str:
+    func = node.func
+    if isinstance(func, ast.Attribute):
+        return func.attr
+    if isinstance(func, ast.Name):
+        return func.id
+    return ""
+
+
+def call_path(node: ast.Call) -> str:
+    # "np.random.normal" for np.random.normal(...); empty when the callee is not a plain dotted name.
+    parts = []
+    func = node.func
+    while isinstance(func, ast.Attribute):
+        parts.append(func.attr)
+        func = func.value
+    if not isinstance(func, ast.Name):
+        return ""
+    parts.append(func.id)
+    return ".".join(reversed(parts))
+
+
+def is_constant(node) -> bool:
+    return isinstance(node, ast.Constant) and node.value is not None
+
+
+def has_seed_keyword(node: ast.Call) -> bool:
+    return any(kw.arg in SEED_KEYWORDS and not (isinstance(kw.value, ast.Constant) and kw.value.value is None)
+               for kw in node.keywords)
+
+
+def seeds_global_rng(node: ast.Call, module_paths: tuple) -> bool:
+    # np.random.seed(42) / random.seed(42): every later unseeded draw from that module is reproducible.
+    return call_path(node) in tuple(f"{m}.seed" for m in module_paths) and bool(node.args) and is_constant(node.args[0])
+
+
+def uncacheable_reason(code: str):
+    if NETWORK_PATTERN.search(code):
+        return "it may access the network"
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return "it could not be parsed"
+
+    calls = sorted((node for node in ast.walk(tree) if isinstance(node, ast.Call)),
+                   key=lambda node: (node.lineno, node.col_offset))
+    numpy_seeded = False
+    random_seeded = False
+    for node in calls:
+        name, path = call_name(node), call_path(node)
+        arg_strings = [arg.value.strip().lower() for arg in node.args
+                       if isinstance(arg, ast.Constant) and isinstance(arg.value, str)]
+        if name in CLOCK_FUNCTIONS or (path in ("time", f"time.{name}") and name in CLOCK_TIME_FUNCTIONS) \
+                or any(value in CLOCK_STRINGS for value in arg_strings):
+            return "it reads the current time"
+
+        # Each random call must be seeded on its own, or by a global seed call that runs before it.
+        if seeds_global_rng(node, ("np.random", "numpy.random")):
+            numpy_seeded = True
+        elif seeds_global_rng(node, ("random",)):
+            random_seeded = True
+        elif name in ALWAYS_RANDOM_CALLS:
+            return "it generates random identifiers"
+        elif path.startswith(("np.random.", "numpy.random.")):
+            if name in ("default_rng", "RandomState", "Generator", "PCG64"):
+                if not (node.args and is_constant(node.args[0])) and not has_seed_keyword(node):
+                    return f"{path}() is created without a fixed seed"
+            elif not numpy_seeded:
+                return f"{path}() draws from an unseeded random generator"
+        elif path.startswith("random."):
+            if not random_seeded:
+                return f"{path}() draws from an unseeded random generator"
+        elif name in RANDOM_STATE_CALLS or (name in SHUFFLE_CALLS and any(
+                kw.arg == "shuffle" and isinstance(kw.value, ast.Constant) and kw.value.value for kw in node.keywords)):
+            if not has_seed_keyword(node) and not numpy_seeded:
+                return f"{name}() uses randomness without a fixed random_state"
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            if SQL_CLOCK_PATTERN.search(node.value):
+                return "its SQL reads the current time"
+            if SQL_RANDOM_PATTERN.search(node.value):
+                return "its SQL uses randomness"
+    return None
+
+
+def hash_dataframe(df: pd.DataFrame) -> str:
+    digest = hashlib.sha256()
+    digest.update(json.dumps([[str(c), str(t)] for c, t in df.dtypes.items()]).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def hash_file(path: str) -> str:
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        if memo_key in _file_hashes:
+            return _file_hashes[memo_key]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    with _file_hashes_lock:
+        # Workspaces are short-lived, so the memo only needs to cover the steps of in-flight requests.
+        if len(_file_hashes) > 1024:
+            _file_hashes.clear()
+        _file_hashes[memo_key] = digest.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def make_step_cache_key(code: str, data: pd.DataFrame = None, files: dict = None, datasets: dict = None,
+                        tables: dict = None, output_name: str = "df"):
+    # Changes whenever the sandbox image is rebuilt or its libraries change, not just when the tag does.
+    runtime_id = get_sandbox_pool().runtime_id
+    if runtime_id is None:
+        log.info("The sandbox runtime is not known yet. Not caching this step.")
+        return None
+    try:
+        payload = json.dumps({
+            "version": STEP_CACHE_VERSION,
+            "runtime": runtime_id,
+            "code": code,
+            "output": output_name,
+            "data": hash_dataframe(data) if isinstance(data, pd.DataFrame) else None,
+            "datasets": {name: hash_dataframe(df) for name, df in (datasets or {}).items()
+                         if isinstance(df, pd.DataFrame)},
+            "files": {name: hash_file(path) for name, path in (files or {}).items()},
+            "tables": tables or {},
+        }, sort_keys=True)
+    except (TypeError, ValueError, OSError) as e:
+        # Frames holding unhashable objects (lists, dicts) simply are not cached.
+        log.info(f"Step inputs cannot be fingerprinted ({e}). Not caching this step.")
+        return None
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class StepCache:
+    def __init__(self, cache_dir: str = STEP_CACHE_DIR, max_bytes: int = STEP_CACHE_MAX_BYTES,
+                 enabled: bool = STEP_CACHE_ENABLED):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+        self._index = OrderedDict()
+        self._total_bytes = 0
+        if enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    @staticmethod
+    def _entry_size(path: str) -> int:
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    def _load_index(self):
+        # Entries are ordered by last access (meta file mtime) so LRU order survives restarts.
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            meta_path = os.path.join(self.cache_dir, name, META_FILE)
+            if not name.startswith(".tmp-") and os.path.exists(meta_path):
+                entries.append((os.path.getmtime(meta_path), name, self._entry_size(self._path(name))))
+            else:
+                shutil.rmtree(self._path(name), ignore_errors=True)
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+        self._evict()
+        log.info(f"Step cache loaded with {len(self._index)} entries ({self._total_bytes} bytes) "
+                 f"from '{self.cache_dir}'.")
+
+    def _remove(self, key: str):
+        self._total_bytes -= self._index.pop(key, 0)
+        shutil.rmtree(self._path(key), ignore_errors=True)
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._index:
+            self._remove(next(iter(self._index)))
+
+    def get(self, key: str):
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                with open(os.path.join(path, STDOUT_FILE), "r", encoding="utf-8") as f:
+                    stdout = f.read()
+                modified_df = read_state_file(path)
+            except (OSError, ValueError):
+                log.warning(f"Discarding unreadable step cache entry {key}.")
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            os.utime(os.path.join(path, META_FILE))
+            self.hits += 1
+            return stdout, modified_df
+
+    def put(self, key: str, stdout: str, modified_df: pd.DataFrame = None):
+        tmp_path = self._path(f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_path)
+        try:
+            with open(os.path.join(tmp_path, STDOUT_FILE), "w", encoding="utf-8") as f:
+                f.write(stdout)
+            if isinstance(modified_df, pd.DataFrame):
+                # Named like the sandbox's own output so read_state_file can load it back.
+                write_state_file(modified_df, tmp_path, name="modified_data")
+            with open(os.path.join(tmp_path, META_FILE), "w", encoding="utf-8") as f:
+                json.dump({"created_at": time.time(), "format": STATE_TRANSFER_FORMAT}, f)
+            size = self._entry_size(tmp_path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            log.warning(f"Could not store step cache entry {key}.", exc_info=True)
+            return
+
+        with self._lock:
+            if size > self.max_bytes or key in self._index:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return
+            os.replace(tmp_path, self._path(key))
+            self._index[key] = size
+            self._total_bytes += size
+            self.stores += 1
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._index),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_step_cache = None
+_step_cache_lock = threading.Lock()
+
+
+def get_step_cache() -> StepCache:
+    global _step_cache
+    with _step_cache_lock:
+        if _step_cache is None:
+            _step_cache = StepCache()
+        return _step_cache
@@ -1,46 +1,194 @@
 import pandas as pd
-import requests
 import docker
+import io
 import os
-import tempfile
+import shutil
+import lxml.html
 from logger_setup import log
+from sandbox_pool import get_sandbox_pool, SANDBOX_IMAGE
+from web_cache import get_web_cache
+from tracing import span
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+# "arrow" hands DataFrames between steps as uncompressed Arrow IPC (Feather v2) files,
+# which keep dtypes and can be memory-mapped by the sandbox. "csv" is the legacy fallback.
+STATE_TRANSFER_FORMAT = os.environ.get("STATE_TRANSFER_FORMAT", "arrow")
+ARROW_OUTPUT_FILE = "modified_data.arrow"
+CSV_OUTPUT_FILE = "modified_data.csv"
+# Step state and the generated script live here, so they can never clash with an uploaded file's name.
+# Uploads are stored under secure_filename names, which never start with a dot.
+STATE_DIR = ".state"
+SCRIPT_FILE = "script.py"
+
+
+def read_tables_by_caption(content: bytes, caption: str) -> list:
+    document = lxml.html.fromstring(content)
+    tables = []
+    for table_element in document.iter("table"):
+        caption_element = table_element.find("caption")
+        if caption_element is not None and caption.lower() in caption_element.text_content().lower():
+            tables.extend(pd.read_html(io.StringIO(lxml.html.tostring(table_element, encoding="unicode"))))
+    return tables
+
+
+def select_table(tables: list, table=None, columns: list = None) -> tuple[int, pd.DataFrame]:
+    candidates = list(enumerate(tables))
+    if columns:
+        wanted = [str(column).lower() for column in columns]
+
+        def has_columns(df: pd.DataFrame) -> bool:
+            names = [" ".join(map(str, c)).lower() if isinstance(c, tuple) else str(c).lower() for c in df.columns]
+            return all(any(w in name for name in names) for w in wanted)
+
+        candidates = [(i, df) for i, df in candidates if has_columns(df)]
+        if not candidates:
+            raise ValueError(f"No HTML table has all of the columns {columns}.")
+    if table is not None:
+        try:
+            return candidates[int(table)]
+        except IndexError:
+            raise ValueError(f"Table index {table} is out of range: only {len(candidates)} matching table(s) found.")
+    return candidates[0]
 
 
-def web_scraper(url: str) -> pd.DataFrame:
+def web_scraper(url: str, table=None, caption: str = None, columns: list = None) -> pd.DataFrame:
     log.info(f"Using basic web_scraper for URL: {url}")
     try:
-        response = requests.get(url, headers={'User-Agent': 'Mozilla/5.0'})
-        response.raise_for_status()
-        tables = pd.read_html(response.content)
+        with span("web_fetch", tool="web_scraper") as fetch_span:
+            content = get_web_cache().fetch(url)
+            fetch_span.add_bytes(len(content))
+        with span("html_parse", tool="web_scraper") as parse_span:
+            parse_span.add_bytes(len(content))
+            if caption:
+                tables = read_tables_by_caption(content, caption)
+            else:
+                tables = pd.read_html(io.BytesIO(content))
         if not tables:
-            raise ValueError("No HTML tables found on this page.")
-        log.info(f"Successfully scraped {len(tables)} table(s). Returning the first one.")
-        return tables[0]
+            raise ValueError("No HTML tables found on this page." if not caption
+                             else f"No HTML table with a caption containing '{caption}' found on this page.")
+        table_index, selected = select_table(tables, table=table, columns=columns)
+        log.info(f"Successfully scraped {len(tables)} table(s). Returning table #{table_index}.")
+        return selected
     except Exception as e:
         log.error(f"Basic web_scraper failed for URL {url}.", exc_info=True)
         raise
 
 
-def python_interpreter(code: str, data: pd.DataFrame = None, filename: str = None) -> tuple[str, pd.DataFrame]:
+def write_state_file(data: pd.DataFrame, directory: str, name: str = "data") -> str:
+    if STATE_TRANSFER_FORMAT == "arrow" and feather is not None:
+        arrow_filename = f"{name}.arrow"
+        path = os.path.join(directory, arrow_filename)
+        try:
+            feather.write_feather(data.reset_index(drop=True), path, compression="uncompressed")
+            return arrow_filename
+        except Exception as e:
+            log.warning(f"Could not write step state as Arrow ({e}). Falling back to CSV.")
+            if os.path.exists(path):
+                os.remove(path)
+    csv_filename = f"{name}.csv"
+    data.to_csv(os.path.join(directory, csv_filename), index=False)
+    return csv_filename
+
+
+def state_loader_code(state_filename: str, variable: str = "df") -> str:
+    state_path = f"{STATE_DIR}/{state_filename}"
+    if state_filename.endswith(".arrow"):
+        return ("import pyarrow.feather as _feather\n"
+                f"{variable} = _feather.read_table('{state_path}', memory_map=True).to_pandas()\n")
+    return f"{variable} = pd.read_csv('{state_path}')\n"
+
+
+def state_writer_code(variable: str = "df") -> str:
+    arrow_path = f"{STATE_DIR}/{ARROW_OUTPUT_FILE}"
+    csv_path = f"{STATE_DIR}/{CSV_OUTPUT_FILE}"
+    if STATE_TRANSFER_FORMAT == "arrow" and feather is not None:
+        return f"""
+if '{variable}' in locals() and isinstance({variable}, pd.DataFrame):
+    try:
+        import pyarrow.feather as _feather
+        _feather.write_feather({variable}.reset_index(drop=True), '{arrow_path}', compression='uncompressed')
+    except Exception:
+        import os as _os
+        if _os.path.exists('{arrow_path}'):
+            _os.remove('{arrow_path}')
+        {variable}.to_csv('{csv_path}', index=False)
+"""
+    return (f"\nif '{variable}' in locals() and isinstance({variable}, pd.DataFrame):\n"
+            f"    {variable}.to_csv('{csv_path}', index=False)")
+
+
+def read_state_file(directory: str):
+    arrow_path = os.path.join(directory, ARROW_OUTPUT_FILE)
+    if os.path.exists(arrow_path):
+        # Read fully rather than memory-mapping: the worker directory is cleared once the step is released.
+        return feather.read_table(arrow_path, memory_map=False).to_pandas()
+    csv_path = os.path.join(directory, CSV_OUTPUT_FILE)
+    if os.path.exists(csv_path):
+        return pd.read_csv(csv_path)
+    return None
+
+
+def link_or_copy(source_path: str, target_path: str) -> bool:
+    # Uploads are shared with the workspace (and every later step), so they are made read-only.
+    # Returns True when the file had to be copied because a hard link was not possible.
+    copied = False
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+        copied = True
+    os.chmod(target_path, 0o444)
+    return copied
+
+
+def duckdb_connection_code(tables: dict) -> str:
+    lines = ["import duckdb", "con = duckdb.connect()"]
+    for table_name, file_name in tables.items():
+        lines.append(f"con.execute(\"CREATE VIEW \\\"{table_name}\\\" AS SELECT * FROM read_parquet('{file_name}')\")")
+    return "\n".join(lines)
+
+
+def python_interpreter(code: str, data: pd.DataFrame = None, files: dict = None,
+                       timeout: float = None, datasets: dict = None,
+                       output_name: str = "df", tables: dict = None) -> tuple[str, pd.DataFrame]:
     log.info("Preparing to execute code in sandboxed environment...")
     log.debug(f"Code to be executed:\n{code}")
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        input_filename = filename if filename else "data.csv"
-        input_data_path = os.path.join(temp_dir, input_filename)
-        output_data_path = os.path.join(temp_dir, "modified_data.csv")
-        script_path = os.path.join(temp_dir, "script.py")
+    with get_sandbox_pool().acquire() as worker:
+        temp_dir = worker.workdir
+        state_dir = os.path.join(temp_dir, STATE_DIR)
+        os.makedirs(state_dir, exist_ok=True)
+        script_path = os.path.join(state_dir, SCRIPT_FILE)
 
         script_code_lines = ["import pandas as pd", "import json", "import re", "from io import BytesIO",
                              "import base64", "import numpy as np"]
 
-        if data is not None and isinstance(data, pd.DataFrame):
-            data.to_csv(input_data_path, index=False)
-            if not filename:
+        with span("input_write", tool="python_interpreter") as write_span:
+            for file_name, source_path in (files or {}).items():
+                if link_or_copy(source_path, os.path.join(temp_dir, file_name)):
+                    write_span.add_bytes(os.path.getsize(source_path))
+                log.info(f"Made file '{file_name}' available read-only. Expecting LLM code to load it.")
+
+            if tables:
+                log.info(f"Opening DuckDB connection 'con' with tables {list(tables)}")
+                script_code_lines.append(duckdb_connection_code(tables))
+
+            if data is not None and isinstance(data, pd.DataFrame):
+                input_filename = write_state_file(data, state_dir)
+                write_span.add_bytes(os.path.getsize(os.path.join(state_dir, input_filename)))
                 log.info(f"Loading data from previous step into 'df' from {input_filename}")
-                script_code_lines.append(f"df = pd.read_csv('/app/{input_filename}')\n")
-            else:
-                log.info(f"Made file '{filename}' available. Expecting LLM code to load it.")
+                script_code_lines.append(state_loader_code(input_filename))
+
+            for slot_name, slot_data in (datasets or {}).items():
+                if isinstance(slot_data, pd.DataFrame):
+                    slot_filename = write_state_file(slot_data, state_dir, name=slot_name)
+                    write_span.add_bytes(os.path.getsize(os.path.join(state_dir, slot_filename)))
+                    log.info(f"Loading data slot '{slot_name}' from {slot_filename}")
+                    script_code_lines.append(state_loader_code(slot_filename, variable=slot_name))
 
         script_code_lines.append(code)
 
@@ -62,49 +210,41 @@ if 'final_answer' in locals():
 """
         script_code_lines.append(json_dump_code)
 
-        script_code_lines.append(
-            "\nif 'df' in locals() and isinstance(df, pd.DataFrame):\n    df.to_csv('/app/modified_data.csv', index=False)"
-        )
+        script_code_lines.append(state_writer_code(output_name))
 
         with open(script_path, "w", encoding="utf-8") as f:
             f.write("\n".join(script_code_lines))
 
-        client = docker.from_env()
-        try:
-            container = client.containers.run(
-                "python:3.10-slim-data-analyst",
-                command=f"python /app/script.py",
-                volumes={temp_dir: {'bind': '/app', 'mode': 'rw'}},
-                working_dir="/app",
-                remove=True, detach=False, stdout=True, stderr=True
-            )
-            stdout = container.decode('utf-8').strip()
-            log.info(f"Interpreter stdout: {stdout[:500]}...")
-
-            modified_df = None
-            if os.path.exists(output_data_path):
-                modified_df = pd.read_csv(output_data_path)
+        # The worker runs with /app (or its host workdir) as cwd, so relative paths resolve the same way.
+        with span("sandbox_execute", tool="python_interpreter") as execute_span:
+            stdout = worker.execute(f"{STATE_DIR}/{SCRIPT_FILE}", timeout=timeout)
+            execute_span.add_bytes(len(stdout))
+            execute_span.set(worker_duration=worker.last_result.get("duration"),
+                             worker_rss_delta_bytes=worker.last_result.get("rss_delta_bytes"),
+                             worker_peak_rss_bytes=worker.last_result.get("max_rss_bytes"))
+        log.info(f"Interpreter stdout: {stdout[:500]}...")
+
+        with span("state_read", tool="python_interpreter") as read_span:
+            modified_df = read_state_file(state_dir)
+            if modified_df is not None:
+                read_span.add_bytes(sum(os.path.getsize(os.path.join(state_dir, name))
+                                        for name in (ARROW_OUTPUT_FILE, CSV_OUTPUT_FILE)
+                                        if os.path.exists(os.path.join(state_dir, name))))
                 log.info("Found modified dataframe. Reading back state.")
-            elif data is not None and filename:
-                modified_df = data
 
-            return stdout, modified_df
-        except docker.errors.ContainerError as e:
-            error_message = e.stderr.decode('utf-8').strip()
-            log.error(f"Error executing code in Docker. STDERR:\n{error_message}")
-            raise RuntimeError(f"Code execution failed: {error_message}")
+        return stdout, modified_df
 
 
 def build_docker_image():
     log.info("Checking for sandbox Docker image...")
     client = docker.from_env()
     try:
-        client.images.get("python:3.10-slim-data-analyst")
+        client.images.get(SANDBOX_IMAGE)
         log.info("Docker image already exists.")
     except docker.errors.ImageNotFound:
         log.info("Docker image not found. Building... (This may take a minute)")
         try:
-            client.images.build(path=".", dockerfile="Dockerfile", tag="python:3.10-slim-data-analyst")
+            client.images.build(path=".", dockerfile="Dockerfile", tag=SANDBOX_IMAGE)
             log.info("Docker image built successfully.")
         except Exception as e:
             log.error(f"FATAL: Failed to build Docker image. Ensure Docker Desktop is running.", exc_info=True)
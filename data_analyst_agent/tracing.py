@@ -0,0 +1,231 @@
+import contextlib
+import contextvars
+import itertools
+import os
+import threading
+import time
+import uuid
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "1") == "1"
+TRACE_FILE = "trace.json"
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is reported in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss_bytes():
+    # Resident set size right now, unlike ru_maxrss which is the process's lifetime high-water mark.
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Span:
+    def __init__(self, span_id: int, name: str, tool: str = None, parent_id: int = None):
+        self.id = span_id
+        self.name = name
+        self.tool = tool
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.duration = None
+        self.bytes = 0
+        self.rss_bytes = None
+        self.rss_delta_bytes = None
+        self.process_peak_rss_bytes = None
+        self.status = "ok"
+        self.attrs = {}
+
+    def add_bytes(self, count: int):
+        self.bytes += int(count or 0)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            "id": self.id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "tool": self.tool,
+            "start_offset": round(self.start - origin, 6),
+            "duration": self.duration,
+            "bytes": self.bytes,
+            "rss_bytes": self.rss_bytes,
+            "rss_delta_bytes": self.rss_delta_bytes,
+            "process_peak_rss_bytes": self.process_peak_rss_bytes,
+            "status": self.status,
+            "attrs": self.attrs,
+        }
+
+
+class Trace:
+    def __init__(self, request_id: str = None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.start = time.time()
+        self.spans = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def new_span(self, name: str, tool: str = None, parent_id: int = None) -> Span:
+        with self._lock:
+            span = Span(next(self._ids), name, tool, parent_id)
+            self.spans.append(span)
+        return span
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = [span.to_dict(self.start) for span in self.spans]
+        return {"request_id": self.request_id, "start": self.start,
+                "duration": time.time() - self.start, "spans": spans}
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+def format_labels(labels: dict) -> str:
+    parts = []
+    for name, value in labels.items():
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{escaped}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.latency = {}
+        self.bytes = {}
+        self.errors = {}
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def record_span(self, span: Span):
+        key = (span.name, span.tool or "")
+        with self._lock:
+            self.latency.setdefault(key, Histogram()).observe(span.duration)
+            self.bytes[key] = self.bytes.get(key, 0) + span.bytes
+            if span.status != "ok":
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def record_request(self, http_status: int):
+        with self._lock:
+            self.requests[http_status] = self.requests.get(http_status, 0) + 1
+
+    def render(self, gauges: dict = None) -> str:
+        lines = []
+        with self._lock:
+            lines.append("# HELP agent_phase_duration_seconds Duration of request phases by phase and tool.")
+            lines.append("# TYPE agent_phase_duration_seconds histogram")
+            for (phase, tool), histogram in sorted(self.latency.items()):
+                labels = {"phase": phase, "tool": tool}
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f"agent_phase_duration_seconds_bucket{format_labels({**labels, 'le': bound})} {count}")
+                lines.append(f"agent_phase_duration_seconds_bucket{format_labels({**labels, 'le': '+Inf'})} "
+                             f"{histogram.count}")
+                lines.append(f"agent_phase_duration_seconds_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"agent_phase_duration_seconds_count{format_labels(labels)} {histogram.count}")
+
+            lines.append("# HELP agent_phase_bytes_total Bytes moved by request phases by phase and tool.")
+            lines.append("# TYPE agent_phase_bytes_total counter")
+            for (phase, tool), total in sorted(self.bytes.items()):
+                lines.append(f"agent_phase_bytes_total{format_labels({'phase': phase, 'tool': tool})} {total}")
+
+            lines.append("# HELP agent_phase_errors_total Request phases that raised, by phase and tool.")
+            lines.append("# TYPE agent_phase_errors_total counter")
+            for (phase, tool), total in sorted(self.errors.items()):
+                lines.append(f"agent_phase_errors_total{format_labels({'phase': phase, 'tool': tool})} {total}")
+
+            lines.append("# HELP agent_requests_total Finished analysis requests by HTTP status.")
+            lines.append("# TYPE agent_requests_total counter")
+            for http_status, total in sorted(self.requests.items()):
+                lines.append(f"agent_requests_total{format_labels({'status': http_status})} {total}")
+
+        peak_rss = peak_rss_bytes()
+        if peak_rss is not None:
+            lines.append("# HELP agent_process_peak_rss_bytes Peak resident set size of the server process.")
+            lines.append("# TYPE agent_process_peak_rss_bytes gauge")
+            lines.append(f"agent_process_peak_rss_bytes {peak_rss}")
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def use_trace(trace: Trace):
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str, tool: str = None, **attrs):
+    # Spans outside a traced request still feed the metrics, they just are not written to a trace file.
+    if not TRACING_ENABLED:
+        yield Span(0, name, tool)
+        return
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    if trace is not None:
+        current = trace.new_span(name, tool, parent.id if parent is not None else None)
+    else:
+        current = Span(0, name, tool)
+    current.set(**attrs)
+    token = _current_span.set(current)
+    rss_at_start = current_rss_bytes()
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        current.status = "error"
+        raise
+    finally:
+        _current_span.reset(token)
+        current.duration = time.perf_counter() - started
+        current.rss_bytes = current_rss_bytes()
+        if current.rss_bytes is not None and rss_at_start is not None:
+            # Concurrent spans share the process, so this is only attributable to the span when it runs alone.
+            current.rss_delta_bytes = current.rss_bytes - rss_at_start
+        current.process_peak_rss_bytes = peak_rss_bytes()
+        metrics.record_span(current)
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    # Executor threads do not inherit context variables, so spans opened by fn would lose their request.
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
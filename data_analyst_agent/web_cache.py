@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from logger_setup import log
+
+WEB_CACHE_ENABLED = os.environ.get("WEB_CACHE_ENABLED", "1") == "1"
+WEB_CACHE_DIR = os.environ.get("WEB_CACHE_DIR", "web_cache")
+WEB_CACHE_TTL_SECONDS = float(os.environ.get("WEB_CACHE_TTL_SECONDS", "3600"))
+WEB_CACHE_MAX_BYTES = int(os.environ.get("WEB_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+WEB_REQUEST_TIMEOUT = float(os.environ.get("WEB_REQUEST_TIMEOUT", "30"))
+WEB_POOL_MAXSIZE = int(os.environ.get("WEB_POOL_MAXSIZE", "16"))
+USER_AGENT = 'Mozilla/5.0'
+
+
+def create_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=WEB_POOL_MAXSIZE, pool_maxsize=WEB_POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({'User-Agent': USER_AGENT})
+    return session
+
+
+class WebCache:
+    def __init__(self, cache_dir: str = WEB_CACHE_DIR, ttl_seconds: float = WEB_CACHE_TTL_SECONDS,
+                 max_bytes: int = WEB_CACHE_MAX_BYTES, enabled: bool = WEB_CACHE_ENABLED):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.session = create_session()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        if enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, url: str) -> tuple[str, str]:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.body"), os.path.join(self.cache_dir, f"{key}.json")
+
+    def _load(self, url: str):
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+        return meta, body
+
+    def _store(self, url: str, response: requests.Response):
+        if "no-store" in response.headers.get("Cache-Control", ""):
+            return
+        body_path, meta_path = self._paths(url)
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+            "size": len(response.content),
+        }
+        with self._lock:
+            with open(body_path + ".tmp", "wb") as f:
+                f.write(response.content)
+            os.replace(body_path + ".tmp", body_path)
+            self._write_meta(meta_path, meta)
+            self._evict()
+
+    @staticmethod
+    def _write_meta(meta_path: str, meta: dict):
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def _evict(self):
+        bodies = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".body"):
+                path = os.path.join(self.cache_dir, name)
+                bodies.append((os.path.getmtime(path), os.path.getsize(path), path))
+        total = sum(size for _, size, _ in bodies)
+        for _, size, path in sorted(bodies):
+            if total <= self.max_bytes:
+                break
+            for stale_path in (path, path[:-len(".body")] + ".json"):
+                try:
+                    os.remove(stale_path)
+                except OSError:
+                    pass
+            total -= size
+
+    def fetch(self, url: str) -> bytes:
+        if not self.enabled:
+            response = self.session.get(url, timeout=WEB_REQUEST_TIMEOUT)
+            response.raise_for_status()
+            return response.content
+
+        meta, body = self._load(url)
+        if meta is not None and time.time() - meta["fetched_at"] < self.ttl_seconds:
+            with self._lock:
+                self.hits += 1
+                self.bytes_saved += len(body)
+            log.info(f"Web cache hit for {url} ({len(body)} bytes).")
+            return body
+
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = self.session.get(url, headers=headers, timeout=WEB_REQUEST_TIMEOUT)
+        if response.status_code == 304 and body is not None:
+            meta["fetched_at"] = time.time()
+            with self._lock:
+                self._write_meta(self._paths(url)[1], meta)
+                self.revalidated += 1
+                self.bytes_saved += len(body)
+            log.info(f"Web cache revalidated {url} (304 Not Modified, {len(body)} bytes saved).")
+            return body
+
+        response.raise_for_status()
+        with self._lock:
+            self.misses += 1
+        self._store(url, response)
+        log.info(f"Web cache miss for {url} ({len(response.content)} bytes downloaded).")
+        return response.content
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.revalidated + self.misses
+            return {
+                "enabled": self.enabled,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.revalidated) / lookups if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+            }
+
+
+_web_cache = None
+_web_cache_lock = threading.Lock()
+
+
+def get_web_cache() -> WebCache:
+    global _web_cache
+    with _web_cache_lock:
+        if _web_cache is None:
+            _web_cache = WebCache()
+        return _web_cache